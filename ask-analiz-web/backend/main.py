@@ -6,7 +6,9 @@ from pydantic import BaseModel
 from typing import List, Dict, Any, Union
 from dotenv import load_dotenv
 from openai import OpenAI
+from output_decoder import Field, OutputDecoder, Schema, missing_fields_prompt
 import json
+from collections import deque
 
 # Load environment variables
 load_dotenv()
@@ -22,9 +24,99 @@ if not api_key:
 # DeepSeek Configuration
 client = OpenAI(
     api_key=api_key,
-    base_url="https://api.deepseek.com"
+    base_url="https://api.deepseek.com",
+    timeout=float(os.getenv("LLM_TIMEOUT", "30")),
+    max_retries=1,
 )
 
+# Providers are picked by measured health: rolling p95 latency and error rate
+LLM_SLOW_MS = float(os.getenv("LLM_SLOW_MS", "8000"))
+LLM_PROBE_AFTER = float(os.getenv("LLM_PROBE_AFTER", "30"))
+
+class Provider:
+    """One OpenAI-compatible backend with its rolling latency and error rate."""
+
+    def __init__(self, client, model, window=100):
+        self.client = client
+        self.model = model
+        self.latencies = deque(maxlen=window)  # seconds, successful calls only
+        self.outcomes = deque(maxlen=window)  # True = error
+        self.last_error = 0.0
+        self.wins = 0
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    @property
+    def error_rate(self):
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def healthy(self):
+        # Over the error rate it is skipped until its last error is LLM_PROBE_AFTER old
+        if len(self.outcomes) < 5 or self.error_rate <= 0.5 or not self.outcomes[-1]:
+            return True
+        return time.monotonic() - self.last_error >= LLM_PROBE_AFTER
+
+    def summary(self):
+        return {
+            "p50_ms": round(self.percentile(50) * 1000, 1),
+            "p95_ms": round(self.percentile(95) * 1000, 1),
+            "error_rate": round(self.error_rate, 3),
+            "samples": len(self.outcomes),
+            "healthy": self.healthy(),
+            "wins": self.wins,
+        }
+
+# Optional fallback provider (any OpenAI-compatible API)
+fallback_key = os.getenv("FALLBACK_LLM_API_KEY")
+providers = [Provider(client, "deepseek-chat")]
+if fallback_key:
+    providers.append(Provider(
+        OpenAI(
+            api_key=fallback_key,
+            base_url=os.getenv("FALLBACK_LLM_BASE_URL") or None,
+            timeout=float(os.getenv("LLM_TIMEOUT", "30")),
+            max_retries=1,
+        ),
+        os.getenv("FALLBACK_LLM_MODEL", "gpt-4o-mini"),
+    ))
+
+def ranked_providers():
+    """Healthy providers in configured order, those with p95 over LLM_SLOW_MS after
+    the faster ones; unhealthy providers last, as a last resort."""
+    healthy = [p for p in providers if p.healthy()]
+    fast = [p for p in healthy if p.percentile(95) * 1000 <= LLM_SLOW_MS]
+    return fast + [p for p in healthy if p not in fast] + [p for p in providers if p not in healthy]
+
+def chat_completion(**kwargs):
+    """Calls the best provider by measured health, falling back to the next on failure."""
+    last_error = None
+    for provider in ranked_providers():
+        started = time.monotonic()
+        try:
+            response = provider.client.chat.completions.create(model=provider.model, **kwargs)
+        except Exception as e:
+            print(f"LLM provider {provider.model} failed: {e}")
+            provider.outcomes.append(True)
+            provider.last_error = time.monotonic()
+            last_error = e
+            continue
+        provider.latencies.append(time.monotonic() - started)
+        provider.outcomes.append(False)
+        provider.wins += 1
+        return response
+    raise last_error
+
+# Tolerant parsing of the model's JSON answer (fences, cut-off output, missing fields)
+ANALYSIS_SCHEMA = Schema(
+    insight=Field(str),
+    risk_score=Field(int, required=False, default=None, nullable=True, minimum=0, maximum=100),
+)
+output_decoder = OutputDecoder(ANALYSIS_SCHEMA)
+
 # Configure CORS
 origins = [
     "http://localhost:3000",
@@ -69,16 +161,27 @@ async def analyze_relationship(request: AnalyzeRequest):
         # System prompt needs to be prepended
         full_messages = [{"role": "system", "content": system_prompt}] + request.messages
 
-        response = client.chat.completions.create(
-            model="deepseek-chat", 
+        response = chat_completion(
             messages=full_messages,
             response_format={"type": "json_object"},
             temperature=0.7,
         )
 
         content = response.choices[0].message.content
-        result = json.loads(content)
-        
+
+        async def ask(missing, broken):
+            # Ask again only for what is missing instead of regenerating the whole analysis
+            retry = chat_completion(
+                messages=full_messages + [
+                    {"role": "assistant", "content": broken or "{}"},
+                    {"role": "user", "content": missing_fields_prompt(missing)},
+                ],
+                response_format={"type": "json_object"},
+                temperature=0.3,
+            )
+            return retry.choices[0].message.content
+
+        result = await output_decoder.complete(content, ask)
         return result
 
     except Exception as e:
@@ -117,8 +220,7 @@ async def generate_confession(request: AnalyzeRequest):
 
         full_messages = [{"role": "system", "content": prompt}] + request.messages
 
-        response = client.chat.completions.create(
-            model="deepseek-chat",
+        response = chat_completion(
             messages=full_messages,
             temperature=0.8, # Creative
         )
@@ -130,6 +232,13 @@ async def generate_confession(request: AnalyzeRequest):
         print(f"Error: {e}")
         return {"confession_text": "İşler biraz karışık... Ama anonim olarak paylaşmak istiyorum."}
 
+@app.get("/stats")
+def stats():
+    return {
+        "providers": {p.model: p.summary() for p in providers},
+        "output": output_decoder.stats(),
+    }
+
 @app.get("/")
 def read_root():
     return {"status": "AskAnaliz Backend Running (DeepSeek Enabled)"}
@@ -0,0 +1,11 @@
+-- Custom system prompts per company (POST /prompts, `prompt_id` in /analyze)
+-- Placeholders: {HARD_FACTS}, {MEMORY_CONTEXT}, {CURRENT_TIME}. Keep them at the
+-- end of the template so the static part stays in the provider's prefix cache.
+
+CREATE TABLE IF NOT EXISTS company_prompts (
+    company_id UUID REFERENCES companies(id) ON DELETE CASCADE,
+    prompt_id TEXT NOT NULL,
+    template TEXT NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (company_id, prompt_id)
+);
@@ -0,0 +1,9 @@
+-- EXPORT INDEXES
+-- GET /export/{table} pages through one company's rows in (created_at, id) order
+-- (keyset pagination). These indexes make every page a short range scan.
+-- On the month-partitioned chat logs (partition_chat_logs.sql) the index is
+-- created on every partition.
+
+CREATE INDEX IF NOT EXISTS idx_group_logs_company_keyset ON group_chat_logs(company_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_dm_logs_company_keyset ON dm_logs(company_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_site_memory_company_keyset ON site_memory(company_id, created_at, id);
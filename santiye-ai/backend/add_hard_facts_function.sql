@@ -0,0 +1,59 @@
+-- HARD FACTS AGGREGATE
+-- The chat backend used to pull every budget_items row (a real metraj has
+-- thousands) and every completed milestone, then sum them in Python.
+-- This function does the math in Postgres and returns one small JSON object:
+--   supabase.rpc("company_hard_facts", {"p_company_id": ...})
+
+CREATE OR REPLACE FUNCTION company_hard_facts(p_company_id UUID, p_task_limit INT DEFAULT 20)
+RETURNS JSON
+LANGUAGE SQL
+STABLE
+AS $$
+    WITH budget AS (
+        SELECT
+            COUNT(*) AS items,
+            COALESCE(SUM(total_budget), 0) AS planned,
+            COALESCE(SUM(unit_price * used_quantity), 0) AS used
+        FROM budget_items
+        WHERE company_id = p_company_id
+    ),
+    progress AS (
+        SELECT
+            COUNT(*) AS finished_count,
+            COALESCE(SUM(m.weight_points), 0) AS completed_points
+        FROM project_progress p
+        JOIN milestones m ON m.id = p.milestone_id
+        WHERE p.company_id = p_company_id AND p.status = 'completed'
+    ),
+    -- Master list the company works against (own + global templates). Total ~1000.
+    weights AS (
+        SELECT COALESCE(NULLIF(SUM(weight_points), 0), 1000) AS total_points
+        FROM milestones
+        WHERE company_id = p_company_id OR company_id IS NULL
+    ),
+    finished AS (
+        SELECT COALESCE(json_agg(task_name), '[]'::json) AS tasks
+        FROM (
+            SELECT m.task_name
+            FROM project_progress p
+            JOIN milestones m ON m.id = p.milestone_id
+            WHERE p.company_id = p_company_id AND p.status = 'completed'
+            ORDER BY p.completed_at DESC NULLS LAST
+            LIMIT p_task_limit
+        ) t
+    )
+    SELECT json_build_object(
+        'budget_items', budget.items,
+        'planned_budget', budget.planned,
+        'used_budget', budget.used,
+        'completed_points', progress.completed_points,
+        'total_points', weights.total_points,
+        'finished_count', progress.finished_count,
+        'finished_tasks', finished.tasks
+    )
+    FROM budget, progress, weights, finished;
+$$;
+
+-- Indexes so the aggregates stay index scans per company
+CREATE INDEX IF NOT EXISTS idx_budget_items_company ON budget_items(company_id);
+CREATE INDEX IF NOT EXISTS idx_project_progress_company_status ON project_progress(company_id, status);
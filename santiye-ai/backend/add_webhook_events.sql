@@ -0,0 +1,14 @@
+-- Processed Meta webhook events (idempotency)
+-- Meta redelivers the same message/status; the backend claims each key once.
+-- Enable with IDEMPOTENCY_TABLE=webhook_events
+
+CREATE TABLE IF NOT EXISTS webhook_events (
+    event_key TEXT PRIMARY KEY,           -- "msg:<wamid>" or "status:<id>:<status>"
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Old keys are useless after Meta stops retrying (~7 days)
+CREATE INDEX IF NOT EXISTS idx_webhook_events_created ON webhook_events(created_at);
+
+-- Cleanup (run from a cron job):
+-- DELETE FROM webhook_events WHERE created_at < NOW() - INTERVAL '7 days';
@@ -0,0 +1,110 @@
+import math
+from typing import List, Optional, Sequence, Tuple
+
+from log_sink import log
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:  # not installed / no cached encoding: fall back to the estimate
+    _ENCODING = None
+
+
+def estimate_tokens(text: str) -> int:
+    """Token count of `text`: tiktoken when available, else ~3 characters per token
+    (Turkish is agglutinative and non-ASCII heavy, so it runs denser than English)."""
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / 3)
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """Deterministic cut: keeps the head of `text` and marks the cut with "…"."""
+    if estimate_tokens(text) <= budget:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:  # longest prefix that fits, binary search on characters
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid] + "…") <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo] + "…" if lo else ""
+
+
+class ContextPacker:
+    """Fits each prompt section into its own token budget.
+
+    Inputs come in priority order (most important / newest first); items are taken
+    while they fit and the rest is summarized as a count, so the prompt stays bounded
+    however old the project gets, and the same data always packs the same way.
+    """
+
+    def __init__(self, facts: int = 400, memory: int = 800, history: int = 1200):
+        self.budgets = {"facts": facts, "memory": memory, "history": history}
+        self.calls = 0
+        self.total_tokens = 0
+        self.max_tokens = 0
+        self.dropped = {"facts": 0, "memory": 0, "history": 0}
+
+    def pack_lines(self, section: str, lines: Sequence[str], more_label: str = "- (+{n} kayıt daha)",
+                   budget: Optional[int] = None) -> List[str]:
+        budget = self.budgets[section] if budget is None else budget
+        out, used = [], 0
+        for i, line in enumerate(lines):
+            cost = estimate_tokens(line) + 1  # newline
+            if used + cost > budget:
+                left = len(lines) - i
+                self.dropped[section] += left
+                out.append(more_label.format(n=left))
+                break
+            out.append(line)
+            used += cost
+        return out
+
+    def pack_items(self, section: str, items: Sequence[str], budget: int, sep: str = ", ") -> Tuple[List[str], int]:
+        """Items that fit in `budget` tokens when joined with `sep`, and how many were left out."""
+        out, used = [], 0
+        for i, item in enumerate(items):
+            cost = estimate_tokens(item + sep)
+            if used + cost > budget:
+                self.dropped[section] += len(items) - i
+                return out, len(items) - i
+            out.append(item)
+            used += cost
+        return out, 0
+
+    def pack_history(self, messages: List[dict]) -> List[dict]:
+        """Newest turns that fit the history budget; the last turn is always kept (cut if needed)."""
+        budget = self.budgets["history"]
+        kept, used = [], 0
+        for msg in reversed(messages):
+            cost = estimate_tokens(msg["content"]) + 4  # role/format overhead
+            if used + cost > budget:
+                if not kept:
+                    kept.append({**msg, "content": truncate_to_tokens(msg["content"], budget - 4)})
+                self.dropped["history"] += len(messages) - len(kept)
+                break
+            kept.append(msg)
+            used += cost
+        return kept[::-1]
+
+    def record(self, **sections: int):
+        """Logs one call's prompt token counts per section."""
+        total = sum(sections.values())
+        self.calls += 1
+        self.total_tokens += total
+        self.max_tokens = max(self.max_tokens, total)
+        log("prompt_tokens", total=total, **sections)
+
+    def stats(self) -> dict:
+        return {
+            "budgets": self.budgets,
+            "tokenizer": "tiktoken" if _ENCODING is not None else "estimate",
+            "calls": self.calls,
+            "avg_prompt_tokens": round(self.total_tokens / self.calls) if self.calls else 0,
+            "max_prompt_tokens": self.max_tokens,
+            "dropped": self.dropped,
+        }
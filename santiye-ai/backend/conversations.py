@@ -0,0 +1,52 @@
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, List
+
+
+class ConversationWindows:
+    """Last `window` messages per conversation (phone number / group id), kept in memory.
+
+    Each conversation is a ring buffer; conversations are evicted LRU past `maxsize`.
+    A miss warms the window once from the logs (`load`); after that every turn is
+    appended here as it is recorded, so replies need no history read.
+    Relies on the conversation lanes: one conversation is never handled concurrently.
+    """
+
+    def __init__(self, window: int = 6, maxsize: int = 5000):
+        self.window = max(1, window)
+        self.maxsize = maxsize
+        self.data: "OrderedDict[str, Deque[dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, key: str, load: Callable[[], Awaitable[List[dict]]]) -> List[dict]:
+        """Window for `key`, oldest first. `load()` returns the newest rows, oldest first."""
+        if key in self.data:
+            self.hits += 1
+            self.data.move_to_end(key)
+            return list(self.data[key])
+        self.misses += 1
+        rows = await load()
+        self.data[key] = deque(rows[-self.window:], maxlen=self.window)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+        return list(self.data[key])
+
+    def append(self, key: str, message: dict):
+        """Adds a turn to a warm window. Cold windows pick it up from the logs on warm-up."""
+        if key in self.data:
+            self.data[key].append(message)
+            self.data.move_to_end(key)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "conversations": len(self.data),
+            "maxsize": self.maxsize,
+            "window": self.window,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "evictions": self.evictions,
+        }
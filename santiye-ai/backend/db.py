@@ -0,0 +1,83 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from supabase import create_client, Client
+
+from log_sink import log
+from metrics import LatencyWindow
+
+# One client (and so one keep-alive PostgREST session) for the whole process
+supabase: Client = create_client(
+    os.environ.get("NEXT_PUBLIC_SUPABASE_URL", ""),
+    os.environ.get("SUPABASE_SERVICE_KEY", "")
+)
+
+
+class Database:
+    """Runs blocking supabase-py queries on a bounded thread pool.
+
+    supabase-py is synchronous; calling it straight from an `async def` freezes the
+    event loop for every PostgREST round trip. Here each query runs in a worker
+    thread with a deadline, and its latency is recorded under a short name.
+    """
+
+    def __init__(self, client: Client, max_workers: int = 8, timeout: float = 10.0, slow_ms: float = 500.0):
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="supabase")
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.slow_ms = slow_ms
+        self.timings: Dict[str, LatencyWindow] = {}
+        self.errors: Dict[str, int] = {}
+        self.timeouts = 0
+
+    def table(self, name: str):
+        return self.client.table(name)
+
+    async def run(self, name: str, fn: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        """Runs `fn()` on the pool. Raises asyncio.TimeoutError past the deadline."""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(self.executor, fn), timeout=timeout or self.timeout
+            )
+        except asyncio.TimeoutError:
+            # The thread finishes on its own; the caller (and the loop) moves on
+            self.timeouts += 1
+            log("db_timeout", level="error", query=name)
+            raise
+        except Exception:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.timings.setdefault(name, LatencyWindow(200)).observe(elapsed)
+            if elapsed * 1000 > self.slow_ms:
+                log("db_slow_query", level="warning", query=name, ms=round(elapsed * 1000))
+
+    async def execute(self, name: str, query, timeout: Optional[float] = None):
+        """`await db.execute("profiles.by_phone", supabase.table(...).select(...).eq(...))`"""
+        return await self.run(name, query.execute, timeout=timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "queries": {name: w.summary() for name, w in sorted(self.timings.items())},
+        }
+
+
+db = Database(
+    supabase,
+    max_workers=int(os.environ.get("DB_MAX_WORKERS", "8")),
+    timeout=float(os.environ.get("DB_TIMEOUT", "10")),
+    slow_ms=float(os.environ.get("DB_SLOW_MS", "500")),
+)
@@ -0,0 +1,44 @@
+import csv
+import io
+import json
+from typing import AsyncIterator, Optional
+
+from keyset import keyset_pages
+from log_sink import log
+
+# Exportable tables and the columns a site manager gets (raw_payload stays internal)
+EXPORT_COLUMNS = {
+    "group_chat_logs": ["created_at", "id", "group_id", "sender_phone", "sender_name", "message_type", "content", "media_url"],
+    "dm_logs": ["created_at", "id", "phone_number", "role", "content"],
+    "site_memory": ["created_at", "id", "category", "content"],
+}
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+
+
+async def stream_export(db, table: str, company_id: str, fmt: str = "ndjson",
+                        since: Optional[str] = None, until: Optional[str] = None,
+                        page_size: int = 1000) -> AsyncIterator[bytes]:
+    """Yields one company's rows of `table` as NDJSON or CSV, one keyset page at a time."""
+    columns = EXPORT_COLUMNS[table]
+    rows_sent = 0
+    if fmt == "csv":
+        # BOM so Excel opens the Turkish characters correctly
+        yield ("\ufeff" + ",".join(columns) + "\r\n").encode("utf-8")
+    try:
+        async for page in keyset_pages(db, table, ", ".join(columns), filters={"company_id": company_id},
+                                       since=since, until=until, page_size=page_size):
+            if fmt == "csv":
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                writer.writerows([[r.get(c) for c in columns] for r in page])
+                chunk = buf.getvalue()
+            else:
+                chunk = "".join(json.dumps({c: r.get(c) for c in columns}, ensure_ascii=False) + "\n" for r in page)
+            rows_sent += len(page)
+            yield chunk.encode("utf-8")
+    except Exception as e:
+        # Headers are already sent; the truncated file is all we can signal
+        log("export_error", level="error", table=table, company_id=company_id, rows=rows_sent, error=str(e))
+        raise
+    log("export_done", table=table, company_id=company_id, format=fmt, rows=rows_sent)
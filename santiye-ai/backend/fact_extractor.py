@@ -0,0 +1,149 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List
+
+from context_packer import estimate_tokens
+from log_sink import log
+from metrics import LatencyWindow
+from output_decoder import loads_lenient
+
+EXTRACT_PROMPT = """You read the raw chat of a Turkish construction site WhatsApp group.
+Extract only facts worth remembering for the site chief: deliveries and shortages
+("demir geldi", "çimento bitti"), breakdowns ("vinç arızalı"), safety issues,
+finished or started work, dates and quantities. Ignore greetings, jokes, questions
+without an answer and anything already obvious. Write each fact as one short
+Turkish sentence including who/what/quantity when given. If nothing is worth
+remembering, return an empty list.
+
+OUTPUT FORMAT (JSON)
+{"facts": [{"content": "...", "category": "material|safety|progress|issue|general"}]}
+"""
+CATEGORIES = {"material", "safety", "progress", "issue", "general"}
+
+
+class FactExtractor:
+    """Micro-batches untriggered group messages per company into one LLM call.
+
+    A company's batch is sent when its oldest message is `window` seconds old or
+    its text reaches `max_tokens`; at most `max_concurrency` extraction calls run
+    at once, so cost scales with batches, not with messages.
+    """
+
+    def __init__(self, router, save: Callable[[str, List[dict]], Awaitable[None]], window: float = 60.0,
+                 max_tokens: int = 2000, max_concurrency: int = 2, min_chars: int = 8,
+                 route: str = "extract"):
+        self.router = router
+        self.save = save
+        self.window = window
+        self.max_tokens = max_tokens
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.min_chars = min_chars
+        self.route = route
+        self.batches: Dict[str, List[str]] = {}
+        self.first_seen: Dict[str, float] = {}
+        self.tokens: Dict[str, int] = {}
+        self.running: set = set()
+        self.task = None
+        self.call_latency = LatencyWindow(200)
+        self.counters = {"messages": 0, "skipped": 0, "batches": 0, "facts": 0, "failed_batches": 0}
+
+    def add(self, company_id: str, sender: str, text: str, created_at: str):
+        text = (text or "").strip()
+        if len(text) < self.min_chars:
+            self.counters["skipped"] += 1
+            return
+        line = f"[{created_at[:16]}] {sender}: {text}"
+        self.batches.setdefault(company_id, []).append(line)
+        self.first_seen.setdefault(company_id, time.monotonic())
+        self.tokens[company_id] = self.tokens.get(company_id, 0) + estimate_tokens(line)
+        self.counters["messages"] += 1
+        if self.tokens[company_id] >= self.max_tokens:
+            self._spawn(company_id)
+
+    # --- lifecycle ---
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(min(self.window, 5.0))
+            now = time.monotonic()
+            for company_id, since in list(self.first_seen.items()):
+                if now - since >= self.window:
+                    self._spawn(company_id)
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        for company_id in list(self.batches):
+            self._spawn(company_id)
+        await asyncio.gather(*self.running, return_exceptions=True)
+
+    # --- extraction ---
+    def _spawn(self, company_id: str):
+        lines = self.batches.pop(company_id, None)
+        self.first_seen.pop(company_id, None)
+        self.tokens.pop(company_id, None)
+        if not lines:
+            return
+        task = asyncio.create_task(self._extract(company_id, lines))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def _extract(self, company_id: str, lines: List[str]):
+        async with self.semaphore:
+            started = time.perf_counter()
+            try:
+                response = await self.router.call(self.route, lambda model: lambda c: c.chat.completions.create(
+                    model=model,
+                    messages=[
+                        {"role": "system", "content": EXTRACT_PROMPT},
+                        {"role": "user", "content": "\n".join(lines)},
+                    ],
+                    temperature=0.1,
+                    response_format={"type": "json_object"},
+                ))
+                facts = parse_facts(response.choices[0].message.content)
+            except Exception as e:
+                self.counters["failed_batches"] += 1
+                log("fact_extract_error", level="error", company_id=company_id, messages=len(lines), error=str(e))
+                return
+            finally:
+                self.call_latency.observe(time.perf_counter() - started)
+        self.counters["batches"] += 1
+        self.counters["facts"] += len(facts)
+        log("facts_extracted", company_id=company_id, messages=len(lines), facts=len(facts))
+        if facts:
+            await self.save(company_id, facts)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "pending_companies": len(self.batches),
+            "pending_messages": sum(len(b) for b in self.batches.values()),
+            "running": len(self.running),
+            "call_latency": self.call_latency.summary(),
+        }
+
+
+def parse_facts(content: str) -> List[dict]:
+    data, _ = loads_lenient(content or "{}")  # fenced or cut-off output is still used
+    if isinstance(data, list):
+        data = {"facts": data}
+    facts = []
+    items = data.get("facts") if isinstance(data, dict) else None
+    for item in items if isinstance(items, list) else []:
+        if isinstance(item, str):
+            item = {"content": item}
+        # A malformed item (number, list, non-string content) is skipped, not the whole batch
+        value = item.get("content") if isinstance(item, dict) else None
+        text = value.strip() if isinstance(value, str) else ""
+        if text:
+            category = item.get("category")
+            if not isinstance(category, str) or category not in CATEGORIES:
+                category = "general"
+            facts.append({"content": text, "category": category})
+    return facts
@@ -0,0 +1,74 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import httpx
+
+try:
+    import h2  # noqa: F401  (httpx only speaks HTTP/2 when h2 is installed)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+GRAPH_API_URL = "https://graph.facebook.com/v17.0"
+
+
+class GraphClient:
+    """Shared async HTTP client for the WhatsApp Graph API.
+
+    One keep-alive connection pool for the whole process instead of a fresh
+    blocking `requests` call (and TLS handshake) per message.
+    """
+
+    def __init__(self, max_connections: int = 20, max_concurrency: int = 10, timeout: float = 10.0):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+                timeout=httpx.Timeout(self.timeout),
+            )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    @staticmethod
+    def auth_headers() -> dict:
+        return {"Authorization": f"Bearer {os.environ.get('WHATSAPP_API_TOKEN', '')}"}
+
+    async def request(self, method: str, url: str, timeout: Optional[float] = None, **kwargs) -> httpx.Response:
+        """Bounded-concurrency request. `timeout` overrides the client default for this call."""
+        if self.client is None:
+            await self.start()
+        headers = {**self.auth_headers(), **kwargs.pop("headers", {})}
+        async with self.semaphore:
+            return await self.client.request(
+                method, url, headers=headers,
+                timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT,
+                **kwargs,
+            )
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, timeout: Optional[float] = None, **kwargs):
+        """Like request() but the body is read incrementally via `response.aiter_bytes()`."""
+        if self.client is None:
+            await self.start()
+        headers = {**self.auth_headers(), **kwargs.pop("headers", {})}
+        async with self.semaphore:
+            async with self.client.stream(
+                method, url, headers=headers,
+                timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT,
+                **kwargs,
+            ) as response:
+                yield response
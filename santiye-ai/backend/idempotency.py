@@ -0,0 +1,75 @@
+from typing import List, Optional
+
+from log_sink import log
+from ttl_cache import TTLCache
+
+
+def webhook_event_keys(payload: dict) -> List[str]:
+    """Idempotency keys for every message (wamid) and status update in a Meta payload.
+
+    A status id repeats for sent/delivered/read, so the status itself is part of the key.
+    """
+    keys = []
+    for entry in payload.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+            for msg in value.get("messages") or []:
+                if msg.get("id"):
+                    keys.append(f"msg:{msg['id']}")
+            for st in value.get("statuses") or []:
+                if st.get("id"):
+                    keys.append(f"status:{st['id']}:{st.get('status', '')}")
+    return keys
+
+
+class IdempotencyStore:
+    """Rejects redelivered webhook events before any expensive work.
+
+    Tier 1 is an in-memory LRU with TTL (O(1), checked in the webhook itself).
+    Tier 2 is an optional Supabase table with a unique key, claimed by the worker,
+    so duplicates are still caught after a restart or across instances.
+    """
+
+    def __init__(self, maxsize: int = 50000, ttl: float = 24 * 3600, db=None, table: Optional[str] = None):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.db = db
+        self.table = table
+        self.checked = 0
+        self.duplicates = 0
+        self.persistent_duplicates = 0
+
+    def filter_new(self, keys: List[str]) -> List[str]:
+        """Keys not seen before. Every already-seen key counts as a rejected duplicate."""
+        keys = list(dict.fromkeys(keys))
+        self.checked += len(keys)
+        fresh = [k for k in keys if not self.cache.contains(k)]
+        self.duplicates += len(keys) - len(fresh)
+        return fresh
+
+    def mark(self, keys: List[str]):
+        for k in keys:
+            self.cache.set(k, True)
+
+    async def claim(self, key: str) -> bool:
+        """Claims a key in the persistent table. False means another delivery already did."""
+        if not self.db or not self.table:
+            return True
+        try:
+            await self.db.execute(f"{self.table}.claim", self.db.table(self.table).insert({"event_key": key}))
+            return True
+        except Exception as e:
+            # 23505 = unique_violation: the event was processed before
+            if "23505" in str(e) or "duplicate key" in str(e):
+                self.persistent_duplicates += 1
+                return False
+            log("idempotency_claim_error", level="error", key=key, error=str(e))
+            return True
+
+    def stats(self) -> dict:
+        return {
+            "checked": self.checked,
+            "duplicates_rejected": self.duplicates,
+            "persistent_duplicates_rejected": self.persistent_duplicates,
+            "persistent": bool(self.db and self.table),
+            "cache": self.cache.stats(),
+        }
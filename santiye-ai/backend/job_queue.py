@@ -0,0 +1,93 @@
+import asyncio
+import contextvars
+import time
+from typing import Awaitable, Callable
+
+from log_sink import log
+from metrics import LatencyWindow
+
+
+class JobQueue:
+    """Bounded in-process job queue drained by a pool of asyncio workers.
+
+    The webhook only validates and enqueues; the slow pipeline (media, LLM,
+    Supabase, Graph API) runs here so Meta gets its 200 in milliseconds.
+    """
+
+    def __init__(self, concurrency: int = 4, maxsize: int = 1000, name: str = "jobs"):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.workers = []
+        self.accepting = False
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_latency = LatencyWindow()
+        self.run_latency = LatencyWindow()
+
+    def start(self):
+        if self.workers:
+            return
+        self.accepting = True
+        for i in range(self.concurrency):
+            self.workers.append(asyncio.create_task(self._worker(i)))
+        log("workers_started", queue=self.name, workers=self.concurrency)
+
+    def submit(self, fn: Callable[..., Awaitable], *args) -> bool:
+        """Enqueues `fn(*args)` without waiting. False if full or shutting down."""
+        if not self.accepting:
+            self.rejected += 1
+            return False
+        try:
+            self.queue.put_nowait((time.perf_counter(), contextvars.copy_context(), fn, args))
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    async def _worker(self, idx: int):
+        while True:
+            enqueued_at, ctx, fn, args = await self.queue.get()
+            # Carry the submitter's context vars (correlation id) into this job
+            for var, value in ctx.items():
+                var.set(value)
+            started = time.perf_counter()
+            self.wait_latency.observe(started - enqueued_at)
+            self.in_flight += 1
+            try:
+                await fn(*args)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                log("job_error", level="error", queue=self.name, worker=idx, error=str(e))
+            finally:
+                self.in_flight -= 1
+                self.run_latency.observe(time.perf_counter() - started)
+                self.queue.task_done()
+
+    async def shutdown(self, timeout: float = 20.0):
+        """Stops accepting jobs, waits for queued work to finish, then stops workers."""
+        self.accepting = False
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            log("drain_timeout", level="warning", queue=self.name, dropped=self.queue.qsize())
+        for w in self.workers:
+            w.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.queue.qsize(),
+            "maxsize": self.queue.maxsize,
+            "workers": len(self.workers),
+            "in_flight": self.in_flight,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_latency": self.wait_latency.summary(),
+            "run_latency": self.run_latency.summary(),
+        }
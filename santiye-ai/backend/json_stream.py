@@ -0,0 +1,134 @@
+import json
+from typing import Dict, Iterable, List, Optional, Tuple
+
+ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JSONFieldStream:
+    """Incremental reader for a streamed top-level JSON object.
+
+    Fed the model's output chunk by chunk, it returns the decoded text of the
+    `streamed` string fields as it arrives (for SSE), and collects every top-level
+    field's final value in `values` as soon as that field is complete; `closed`
+    says the top-level object ended, i.e. `values` holds the whole answer.
+    """
+
+    def __init__(self, streamed: Iterable[str] = ("insight",)):
+        self.streamed = set(streamed)
+        self.values: Dict[str, object] = {}
+        self.text: List[str] = []
+        self.depth = 0
+        self.in_string = False
+        self.escape = None  # None, "" (after backslash) or the \u hex digits so far
+        self.high_surrogate = None
+        self.string_role = None  # "key", "value" (top-level string value) or None (nested)
+        self.key: Optional[str] = None
+        self.expect = "key"  # at depth 1: "key", "value" or "done" (value read, waiting for ",")
+        self.buf: List[str] = []
+        self.collecting = False  # inside a non-string top-level value
+        self.raw: List[str] = []
+        self.closed = False
+
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        """Returns [(field, text_delta), ...] for the streamed fields in this chunk."""
+        self.text.append(chunk)
+        deltas: List[Tuple[str, str]] = []
+        for ch in chunk:
+            out = self._char(ch)
+            if out:
+                if deltas and deltas[-1][0] == self.key:
+                    deltas[-1] = (self.key, deltas[-1][1] + out)
+                else:
+                    deltas.append((self.key, out))
+        return deltas
+
+    def _char(self, ch: str) -> Optional[str]:
+        if self.in_string:
+            return self._string_char(ch)
+        if self.depth == 1 and self.expect == "value" and not self.collecting \
+                and not ch.isspace() and ch not in ':"':
+            # Number, true/false/null or a nested object/array
+            self.collecting = True
+        if self.collecting:
+            if self.depth == 1 and ch in ",}":
+                self._finish_raw()
+            else:
+                self.raw.append(ch)
+        if ch == '"':
+            self.in_string = True
+            if self.depth == 1 and self.expect == "key":
+                self.string_role = "key"
+            elif self.depth == 1 and self.expect == "value":
+                self.string_role = "value"
+            else:
+                self.string_role = None
+            self.buf = []
+        elif ch in "{[":
+            self.depth += 1
+        elif ch in "}]":
+            self.depth -= 1
+            if self.depth == 0:
+                self.closed = True
+        elif ch == ":" and self.depth == 1:
+            self.expect = "value"
+        elif ch == "," and self.depth == 1:
+            self.expect = "key"
+        return None
+
+    def _string_char(self, ch: str) -> Optional[str]:
+        if self.collecting:
+            self.raw.append(ch)
+        decoded = None
+        if self.escape is not None:
+            if self.escape == "" and ch != "u":
+                decoded = ESCAPES.get(ch, ch)
+                self.escape = None
+            elif self.escape == "":
+                self.escape = "u"
+            else:
+                self.escape += ch
+                if len(self.escape) == 5:
+                    code = int(self.escape[1:], 16)
+                    self.escape = None
+                    if 0xD800 <= code < 0xDC00:
+                        self.high_surrogate = code
+                        return None
+                    if self.high_surrogate is not None and 0xDC00 <= code < 0xE000:
+                        code = 0x10000 + ((self.high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+                    self.high_surrogate = None
+                    decoded = chr(code)
+        elif ch == "\\":
+            self.escape = ""
+            return None
+        elif ch == '"':
+            self.in_string = False
+            value = "".join(self.buf)
+            if self.string_role == "key":
+                self.key = value
+            elif self.string_role == "value":
+                self.values[self.key] = value
+                self.expect = "done"
+            return None
+        else:
+            decoded = ch
+
+        if decoded is None:
+            return None
+        self.buf.append(decoded)
+        if self.string_role == "value" and self.key in self.streamed:
+            return decoded
+        return None
+
+    def _finish_raw(self):
+        raw = "".join(self.raw).strip()
+        self.raw = []
+        self.collecting = False
+        try:
+            self.values[self.key] = json.loads(raw)
+        except ValueError:
+            self.values[self.key] = raw
+        self.expect = "done"
+
+    @property
+    def content(self) -> str:
+        return "".join(self.text)
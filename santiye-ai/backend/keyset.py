@@ -0,0 +1,31 @@
+from typing import AsyncIterator, Dict, List, Optional
+
+
+async def keyset_pages(db, table: str, columns: str, filters: Optional[Dict[str, str]] = None,
+                       since: Optional[str] = None, until: Optional[str] = None,
+                       page_size: int = 1000) -> AsyncIterator[List[dict]]:
+    """Yields `table` rows page by page in (created_at, id) order.
+
+    Each page continues after the last (created_at, id) seen instead of using
+    OFFSET, so page N costs the same index range scan as page 1 and only one page
+    is held in memory. `columns` must include `id` and `created_at`.
+    """
+    last = None
+    while True:
+        query = db.table(table).select(columns)
+        for column, value in (filters or {}).items():
+            query = query.eq(column, value)
+        if since:
+            query = query.gte("created_at", since)
+        if until:
+            query = query.lt("created_at", until)
+        if last:
+            ts, row_id = last["created_at"], last["id"]
+            query = query.or_(f'created_at.gt."{ts}",and(created_at.eq."{ts}",id.gt.{row_id})')
+        res = await db.execute(f"{table}.keyset", query.order("created_at").order("id").limit(page_size))
+        rows = res.data or []
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        last = rows[-1]
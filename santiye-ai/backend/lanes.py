@@ -0,0 +1,103 @@
+import asyncio
+import contextvars
+import time
+import zlib
+from typing import Awaitable, Callable
+
+from log_sink import log
+from metrics import LatencyWindow
+
+
+class Lane:
+    """One serial mailbox: jobs run strictly one after another, in arrival order."""
+
+    def __init__(self, idx: int, depth: int):
+        self.idx = idx
+        self.mailbox: asyncio.Queue = asyncio.Queue(maxsize=depth)
+        self.task = None
+        self.busy = False
+        self.processed = 0
+        self.failed = 0
+        self.high_water = 0
+
+
+class LaneExecutor:
+    """Sharded actor executor: each key (phone number / group id) maps to one lane.
+
+    Messages of the same conversation never overlap, so record_dm -> fetch_dm_history
+    always sees the previous turn, while different conversations run in parallel.
+    No global lock: a lane is a Queue plus one task.
+    """
+
+    def __init__(self, lanes: int = 16, mailbox_depth: int = 100, name: str = "lanes"):
+        self.name = name
+        self.lanes = [Lane(i, mailbox_depth) for i in range(max(1, lanes))]
+        self.mailbox_depth = mailbox_depth
+        self.wait_latency = LatencyWindow()
+        self.run_latency = LatencyWindow()
+
+    def lane_for(self, key: str) -> Lane:
+        # crc32 instead of hash(): stable across processes and restarts
+        return self.lanes[zlib.crc32(str(key).encode("utf-8")) % len(self.lanes)]
+
+    def start(self):
+        for lane in self.lanes:
+            if lane.task is None:
+                lane.task = asyncio.create_task(self._run(lane))
+
+    async def submit(self, key: str, fn: Callable[..., Awaitable], *args):
+        """Queues `fn(*args)` on the key's lane. Waits (backpressure) if the mailbox is full."""
+        lane = self.lane_for(key)
+        await lane.mailbox.put((time.perf_counter(), contextvars.copy_context(), fn, args))
+        lane.high_water = max(lane.high_water, lane.mailbox.qsize())
+
+    async def _run(self, lane: Lane):
+        while True:
+            enqueued_at, ctx, fn, args = await lane.mailbox.get()
+            for var, value in ctx.items():
+                var.set(value)
+            started = time.perf_counter()
+            self.wait_latency.observe(started - enqueued_at)
+            lane.busy = True
+            try:
+                await fn(*args)
+                lane.processed += 1
+            except Exception as e:
+                lane.failed += 1
+                log("lane_error", level="error", executor=self.name, lane=lane.idx, error=str(e))
+            finally:
+                lane.busy = False
+                self.run_latency.observe(time.perf_counter() - started)
+                lane.mailbox.task_done()
+
+    async def shutdown(self, timeout: float = 20.0):
+        """Lets every mailbox drain (bounded by timeout), then stops the lane tasks."""
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(lane.mailbox.join() for lane in self.lanes)), timeout=timeout
+            )
+        except asyncio.TimeoutError:
+            left = sum(lane.mailbox.qsize() for lane in self.lanes)
+            log("drain_timeout", level="warning", executor=self.name, dropped=left)
+        tasks = [lane.task for lane in self.lanes if lane.task]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for lane in self.lanes:
+            lane.task = None
+
+    def stats(self) -> dict:
+        depths = [lane.mailbox.qsize() for lane in self.lanes]
+        return {
+            "lanes": len(self.lanes),
+            "mailbox_depth": self.mailbox_depth,
+            "busy": sum(1 for lane in self.lanes if lane.busy),
+            "queued": sum(depths),
+            "max_queued": max(depths),
+            "high_water": max(lane.high_water for lane in self.lanes),
+            "processed": sum(lane.processed for lane in self.lanes),
+            "failed": sum(lane.failed for lane in self.lanes),
+            "wait_latency": self.wait_latency.summary(),
+            "run_latency": self.run_latency.summary(),
+            "per_lane": depths,
+        }
@@ -0,0 +1,232 @@
+import asyncio
+import random
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError
+
+from log_sink import log
+from metrics import Histogram, LatencyWindow
+
+
+class CircuitOpen(Exception):
+    """The provider failed repeatedly; calls fail fast until the cooldown ends."""
+
+
+class CircuitBreaker:
+    """closed -> open after `threshold` consecutive failures -> one trial call
+    (half-open) after `cooldown` seconds -> closed again on success."""
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+        self.opens = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial:
+            self.trial = True
+            return True
+        return False
+
+    def release(self):
+        """The trial call was cancelled: no verdict, let the next call try."""
+        self.trial = False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        if self.trial or self.failures >= self.threshold:
+            if self.opened_at is None or self.trial:
+                self.opens += 1
+            self.opened_at = time.monotonic()
+            self.trial = False
+
+
+def retryable(e: Exception) -> bool:
+    if isinstance(e, (asyncio.TimeoutError, APIConnectionError)):
+        return True
+    if isinstance(e, APIStatusError):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return False
+
+
+class LLMGateway:
+    """Shared AsyncOpenAI client for one provider (DeepSeek, OpenAI).
+
+    Every call goes through a semaphore (bounded in-flight requests), a per-attempt
+    timeout inside an overall deadline, jittered retries on 429/5xx/network errors
+    and a circuit breaker, so a slow or dead provider can't pile up requests.
+    """
+
+    def __init__(self, name: str, api_key: Optional[str], base_url: Optional[str] = None,
+                 max_concurrency: int = 8, timeout: float = 30.0, deadline: float = 60.0,
+                 max_retries: int = 2, base_delay: float = 0.5,
+                 breaker_threshold: int = 5, breaker_cooldown: float = 30.0):
+        self.name = name
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self._client: Optional[AsyncOpenAI] = None
+        self.in_flight = 0
+        self.latency: Dict[str, LatencyWindow] = {}
+        self.histogram: Dict[str, Histogram] = {}
+        self.counters = {"calls": 0, "ok": 0, "failed": 0, "retries": 0, "timeouts": 0, "rejected_open": 0}
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.api_key)
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        # Created on first use: AsyncOpenAI refuses to start without a key
+        if self._client is None:
+            # Retries and timeouts are ours, not the SDK's
+            self._client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                       max_retries=0, timeout=self.timeout)
+        return self._client
+
+    async def call(self, op: str, fn: Callable[[AsyncOpenAI], Awaitable[Any]],
+                   timeout: Optional[float] = None, deadline: Optional[float] = None) -> Any:
+        """`await gateway.call("chat", lambda c: c.chat.completions.create(...))`"""
+        self.counters["calls"] += 1
+        if not self.breaker.allow():
+            self.counters["rejected_open"] += 1
+            raise CircuitOpen(f"{self.name} circuit open")
+        is_trial = self.breaker.trial
+
+        loop = asyncio.get_running_loop()
+        give_up_at = loop.time() + (deadline or self.deadline)
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                remaining = give_up_at - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                async with self.semaphore:
+                    self.in_flight += 1
+                    try:
+                        result = await asyncio.wait_for(fn(self.client), timeout=min(timeout or self.timeout, remaining))
+                    finally:
+                        self.in_flight -= 1
+                self.observe(op, time.perf_counter() - started)
+                self.breaker.success()
+                self.counters["ok"] += 1
+                return result
+            except asyncio.CancelledError:
+                # Lost a hedge race / caller went away: not the provider's fault
+                if is_trial:
+                    self.breaker.release()
+                raise
+            except Exception as e:
+                self.observe(op, time.perf_counter() - started)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.counters["timeouts"] += 1
+                if not retryable(e):
+                    # Bad request / auth: the provider answered, so it counts as up
+                    self.breaker.success()
+                    self.counters["failed"] += 1
+                    raise
+                self.breaker.failure()
+                delay = self.base_delay * (2 ** attempt) * (0.5 + random.random())
+                if attempt >= self.max_retries or self.breaker.state == "open" or loop.time() + delay >= give_up_at:
+                    self.counters["failed"] += 1
+                    log("llm_call_failed", level="error", provider=self.name, op=op, attempts=attempt + 1,
+                        error=str(e) or type(e).__name__)
+                    raise
+                attempt += 1
+                self.counters["retries"] += 1
+                await asyncio.sleep(delay)
+
+    async def stream(self, op: str, fn: Callable[[AsyncOpenAI], Awaitable[Any]],
+                     idle_timeout: Optional[float] = None) -> AsyncIterator[Any]:
+        """Yields the chunks of a `stream=True` call, holding a concurrency slot throughout.
+
+        Not retried: once chunks have been passed on, a retry would repeat output.
+        Each chunk must arrive within `idle_timeout` (default: the call timeout).
+        """
+        self.counters["calls"] += 1
+        if not self.breaker.allow():
+            self.counters["rejected_open"] += 1
+            raise CircuitOpen(f"{self.name} circuit open")
+        is_trial = self.breaker.trial
+
+        started = time.perf_counter()
+        async with self.semaphore:
+            self.in_flight += 1
+            response = None
+            try:
+                response = await asyncio.wait_for(fn(self.client), timeout=self.timeout)
+                chunks = response.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=idle_timeout or self.timeout)
+                    except StopAsyncIteration:
+                        break
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                # SSE client disconnected mid-stream: no outcome to record
+                if is_trial:
+                    self.breaker.release()
+                raise
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self.counters["timeouts"] += 1
+                if retryable(e):
+                    self.breaker.failure()
+                else:
+                    self.breaker.success()
+                self.counters["failed"] += 1
+                log("llm_stream_failed", level="error", provider=self.name, op=op, error=str(e) or type(e).__name__)
+                raise
+            finally:
+                self.in_flight -= 1
+                self.observe(op, time.perf_counter() - started)
+                if response is not None and hasattr(response, "close"):
+                    await response.close()
+        self.breaker.success()
+        self.counters["ok"] += 1
+
+    def observe(self, op: str, seconds: float):
+        self.latency.setdefault(op, LatencyWindow(200)).observe(seconds)
+        self.histogram.setdefault(op, Histogram()).observe(seconds)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "breaker": self.breaker.state,
+            "breaker_opens": self.breaker.opens,
+            "latency": {op: w.summary() for op, w in sorted(self.latency.items())},
+            "histogram": {op: h.summary() for op, h in sorted(self.histogram.items())},
+        }
@@ -0,0 +1,236 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from llm_gateway import CircuitOpen, LLMGateway
+from log_sink import log
+from metrics import LatencyWindow
+
+# build(model) -> fn(client) -> awaitable, i.e. the gateway call for one model
+Build = Callable[[str], Callable[[Any], Awaitable[Any]]]
+
+
+class NoHealthyBackend(CircuitOpen):
+    """Every backend of a route is failing (subclass so callers' CircuitOpen handling applies)."""
+
+
+class Target:
+    """One provider + model, with its rolling latency and error rate."""
+
+    def __init__(self, gateway: LLMGateway, model: str, window: int = 100):
+        self.gateway = gateway
+        self.model = model
+        self.name = f"{gateway.name}:{model}"
+        self.latency = LatencyWindow(window)
+        self.outcomes = deque(maxlen=window)  # True = error
+        self.last_error = 0.0
+        self.wins = 0
+
+    def record(self, error: bool, seconds: Optional[float] = None):
+        self.outcomes.append(error)
+        if error:
+            self.last_error = time.monotonic()
+        else:
+            self.latency.observe(seconds)
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def healthy(self, max_error_rate: float, min_samples: int, probe_after: float) -> bool:
+        """A target over the error rate is let through again once its last error is
+        `probe_after` seconds old, and stays in while its latest call succeeded."""
+        if not self.gateway.configured or self.gateway.breaker.state == "open":
+            return False
+        if len(self.outcomes) < min_samples or self.error_rate <= max_error_rate:
+            return True
+        return not self.outcomes[-1] or time.monotonic() - self.last_error >= probe_after
+
+    def summary(self) -> dict:
+        return {
+            "p50_ms": round(self.latency.percentile(50) * 1000, 1),
+            "p95_ms": round(self.latency.percentile(95) * 1000, 1),
+            "error_rate": round(self.error_rate, 3),
+            "samples": len(self.outcomes),
+            "breaker": self.gateway.breaker.state,
+            "wins": self.wins,
+        }
+
+
+class Route:
+    """Policy for one kind of request.
+
+    policy "ordered": first healthy target in the configured order, except that a
+        target whose p95 exceeds `slow_ms` is skipped while a faster healthy one exists.
+    policy "fastest": healthy targets by p95 (targets without enough samples first,
+        so a new backend gets measured).
+    hedge_ms > 0: if the first pick hasn't answered after hedge_ms, the next pick is
+        started too and the first answer wins (for the latency-critical DM path).
+    """
+
+    def __init__(self, name: str, targets: List[Target], policy: str = "ordered",
+                 hedge_ms: float = 0, slow_ms: float = 0, max_error_rate: float = 0.5, min_samples: int = 5,
+                 probe_after: float = 30.0):
+        self.name = name
+        self.targets = targets
+        self.policy = policy
+        self.hedge_ms = hedge_ms
+        self.slow_ms = slow_ms
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.probe_after = probe_after
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+
+    def candidates(self) -> List[Target]:
+        healthy = [t for t in self.targets if t.healthy(self.max_error_rate, self.min_samples, self.probe_after)]
+        if self.policy == "fastest":
+            return sorted(healthy, key=lambda t: (len(t.outcomes) >= self.min_samples, t.latency.percentile(95)))
+        if self.slow_ms and len(healthy) > 1:
+            fast = [t for t in healthy if t.latency.percentile(95) * 1000 <= self.slow_ms]
+            return fast + [t for t in healthy if t not in fast]
+        return healthy
+
+
+class LLMRouter:
+    """Routes each request to the best healthy provider/model for its route, with fallback."""
+
+    def __init__(self, gateways: Dict[str, LLMGateway]):
+        self.gateways = gateways
+        self.routes: Dict[str, Route] = {}
+        self.targets: Dict[str, Target] = {}  # shared across routes: health is per provider+model
+
+    def add_route(self, name: str, targets: List[str], **policy) -> Route:
+        """`targets` are "gateway:model" strings in preference order."""
+        resolved = []
+        for spec in targets:
+            gateway_name, model = spec.split(":", 1)
+            if gateway_name not in self.gateways:
+                log("llm_route_unknown_provider", level="warning", route=name, target=spec)
+                continue
+            if spec not in self.targets:
+                self.targets[spec] = Target(self.gateways[gateway_name], model)
+            resolved.append(self.targets[spec])
+        self.routes[name] = Route(name, resolved, **policy)
+        return self.routes[name]
+
+    async def close(self):
+        for gateway in self.gateways.values():
+            await gateway.close()
+
+    def configured(self, route: str) -> bool:
+        return any(t.gateway.configured for t in self.routes[route].targets)
+
+    async def _attempt(self, route: Route, target: Target, build: Build):
+        started = time.perf_counter()
+        try:
+            result = await target.gateway.call(route.name, build(target.model))
+        except asyncio.CancelledError:
+            raise  # lost a hedge race: not the backend's fault
+        except Exception:
+            target.record(True)
+            raise
+        target.record(False, time.perf_counter() - started)
+        return result
+
+    async def call(self, route_name: str, build: Build) -> Any:
+        """`await router.call("chat", lambda model: lambda c: c.chat.completions.create(model=model, ...))`"""
+        route = self.routes[route_name]
+        candidates = route.candidates()
+        if not candidates:
+            raise NoHealthyBackend(f"no healthy backend for {route_name}")
+
+        if route.hedge_ms and len(candidates) > 1:
+            try:
+                return await self._hedged(route, candidates[0], candidates[1], build)
+            except Exception as e:
+                log("llm_route_failed", level="warning", route=route_name, target="hedge", error=str(e))
+                candidates = candidates[2:]
+                if not candidates:
+                    raise
+
+        last_error = None
+        for i, target in enumerate(candidates):
+            try:
+                result = await self._attempt(route, target, build)
+                target.wins += 1
+                if i:
+                    route.fallbacks += 1
+                return result
+            except Exception as e:
+                last_error = e
+                log("llm_route_failed", level="warning", route=route_name, target=target.name, error=str(e))
+        raise last_error
+
+    async def _hedged(self, route: Route, first: Target, second: Target, build: Build):
+        primary = asyncio.create_task(self._attempt(route, first, build))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=route.hedge_ms / 1000)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done:
+            if primary.exception() is None:
+                first.wins += 1
+                return primary.result()
+            # Failed fast: no race to run, just fall back to the second pick
+            result = await self._attempt(route, second, build)
+            second.wins += 1
+            route.fallbacks += 1
+            return result
+
+        route.hedges += 1
+        backup = asyncio.create_task(self._attempt(route, second, build))
+        tasks = {primary: first, backup: second}
+        pending = set(tasks)
+        error = None
+        try:
+            while pending:
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    if task.exception() is None:
+                        tasks[task].wins += 1
+                        if task is backup:
+                            route.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream(self, route_name: str, build: Build, idle_timeout: Optional[float] = None) -> AsyncIterator[Any]:
+        """Streams from the best target (no hedging or fallback once chunks flow)."""
+        route = self.routes[route_name]
+        candidates = route.candidates()
+        if not candidates:
+            raise NoHealthyBackend(f"no healthy backend for {route_name}")
+        target = candidates[0]
+        started = time.perf_counter()
+        try:
+            async for chunk in target.gateway.stream(route.name, build(target.model), idle_timeout=idle_timeout):
+                yield chunk
+        except Exception:
+            target.record(True)
+            raise
+        target.record(False, time.perf_counter() - started)
+        target.wins += 1
+
+    def stats(self) -> dict:
+        return {
+            "gateways": {name: g.stats() for name, g in sorted(self.gateways.items())},
+            "targets": {name: t.summary() for name, t in sorted(self.targets.items())},
+            "routes": {
+                name: {
+                    "policy": r.policy,
+                    "hedge_ms": r.hedge_ms,
+                    "hedges": r.hedges,
+                    "hedge_wins": r.hedge_wins,
+                    "fallbacks": r.fallbacks,
+                    "targets": [t.name for t in r.targets],
+                }
+                for name, r in sorted(self.routes.items())
+            },
+        }
@@ -0,0 +1,160 @@
+import atexit
+import glob
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+# Set once per webhook call; job/lane workers copy it into the task that runs the job
+correlation_id: ContextVar[str] = ContextVar("correlation_id", default="-")
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+
+def new_correlation_id() -> str:
+    cid = uuid.uuid4().hex[:12]
+    correlation_id.set(cid)
+    return cid
+
+
+class LogSink:
+    """Buffered JSON-lines log file written by a background thread.
+
+    The hot path only builds a dict and puts it on a queue; serialization, disk
+    writes and rotation (by size or age) happen on the flusher thread, so
+    concurrent requests never interleave half lines or block on I/O.
+    """
+
+    def __init__(self, path: str = "santiye.log.jsonl", max_bytes: int = 10 * 1024 * 1024,
+                 rotate_seconds: float = 24 * 3600, backup_count: int = 5,
+                 flush_interval: float = 1.0, payload_sample_rate: float = 0.1,
+                 echo_level: str = "info", max_queue: int = 10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.payload_sample_rate = payload_sample_rate
+        self.echo_level = LEVELS.get(echo_level, 20)
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.written = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.opened_at = time.time()
+
+    # --- producer side (any thread / event loop) ---
+    def emit(self, level: str, event: str, **fields):
+        record = {
+            "ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "level": level,
+            "event": event,
+            "cid": correlation_id.get(),
+            **fields,
+        }
+        if LEVELS.get(level, 20) >= self.echo_level:
+            extra = " ".join(f"{k}={v}" for k, v in fields.items())
+            print(f"[{level.upper()}] {record['cid']} {event} {extra}"[:500])
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def payload(self, event: str, payload: dict, **fields):
+        """Logs a summary always, the full payload only for a sampled fraction."""
+        if random.random() < self.payload_sample_rate:
+            fields["payload"] = payload
+        self.emit("debug", event, **fields)
+
+    # --- flusher thread ---
+    def _ensure_started(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self._run, name="log-sink", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            batch = self._collect(timeout=self.flush_interval)
+            if batch:
+                self._write(batch)
+        while True:
+            batch = self._collect(timeout=0)
+            if not batch:
+                break
+            self._write(batch)
+
+    def _collect(self, timeout: float) -> list:
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=timeout) if timeout else self.queue.get_nowait())
+            while len(batch) < 1000:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _write(self, batch: list):
+        if not batch:
+            return
+        try:
+            self._maybe_rotate()
+            lines = "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in batch)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+            self.written += len(batch)
+        except OSError as e:
+            self.dropped += len(batch)
+            print(f"Log Sink Write Error: {e}")
+
+    def _maybe_rotate(self):
+        if not os.path.exists(self.path):
+            self.opened_at = time.time()
+            return
+        too_big = os.path.getsize(self.path) >= self.max_bytes
+        too_old = time.time() - self.opened_at >= self.rotate_seconds
+        if not (too_big or too_old):
+            return
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        os.replace(self.path, f"{self.path}.{stamp}")
+        self.opened_at = time.time()
+        backups = sorted(glob.glob(f"{glob.escape(self.path)}.*"))
+        for old in backups[:-self.backup_count] if self.backup_count else backups:
+            os.remove(old)
+
+    def stop(self, timeout: float = 5.0):
+        """Flushes everything queued so far (called on shutdown and at exit)."""
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join(timeout=timeout)
+        self.thread = None
+
+    def stats(self) -> dict:
+        return {"queued": self.queue.qsize(), "written": self.written, "dropped": self.dropped, "path": self.path}
+
+
+sink = LogSink(
+    path=os.environ.get("LOG_PATH", "santiye.log.jsonl"),
+    max_bytes=int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+    rotate_seconds=float(os.environ.get("LOG_ROTATE_SECONDS", str(24 * 3600))),
+    backup_count=int(os.environ.get("LOG_BACKUP_COUNT", "5")),
+    flush_interval=float(os.environ.get("LOG_FLUSH_INTERVAL", "1")),
+    payload_sample_rate=float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "0.1")),
+    echo_level=os.environ.get("LOG_ECHO_LEVEL", "info"),
+)
+atexit.register(sink.stop)
+
+
+def log(event: str, level: str = "info", **fields):
+    sink.emit(level, event, **fields)
@@ -1,17 +1,43 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
 import os
-from openai import OpenAI
 import json
-from supabase import create_client, Client
+import asyncio
+import time
 
 import base64  # Added for Image Analysis
 
+from log_sink import log, sink, new_correlation_id
+from db import db, supabase
+from metrics import LatencyWindow, Timer
+from ttl_cache import TTLCache
+from job_queue import JobQueue
+from graph_client import GraphClient, GRAPH_API_URL
+from outbound import OutboundSender
+from media import MediaFile, MediaTooLarge, check_declared_size
+from media_cache import MediaAnalysisCache
+from lanes import LaneExecutor
+from idempotency import IdempotencyStore, webhook_event_keys
+from write_behind import WriteBehindBuffer
+from conversations import ConversationWindows
+from retention import RetentionJob
+from exports import EXPORT_COLUMNS, MEDIA_TYPES, stream_export
+from keyset import keyset_pages
+from memory_index import MemoryIndex
+from fact_extractor import FactExtractor
+from prompts import DAYI_PROMPT, PromptRegistry, PromptTemplate
+from llm_gateway import CircuitOpen, LLMGateway
+from llm_router import LLMRouter
+from json_stream import JSONFieldStream
+from context_packer import ContextPacker, estimate_tokens
+from output_decoder import CHAT_SCHEMA, OutputDecoder, missing_fields_prompt
+
 # Initialize FastAPI
 app = FastAPI()
 
@@ -19,8 +45,8 @@ app = FastAPI()
 try:
     from excel_loader import process_budget_excel
 except ImportError:
-    print("Warning: excel_loader not found. Excel parsing disabled.")
-    def process_budget_excel(a, b): return "Excel modülü eksik."
+    log("excel_loader_missing", level="warning")
+    async def process_budget_excel(a, b): return "Excel modülü eksik."
 
 app.add_middleware(
     CORSMiddleware,
@@ -34,15 +60,190 @@ app.add_middleware(
 async def root():
     return {"status": "Santiye AI is Awake and Ready! 🏗️"}
 
-# Clients
-client = OpenAI(
+# --- BACKGROUND JOBS ---
+job_queue = JobQueue(
+    concurrency=int(os.environ.get("WEBHOOK_WORKERS", "4")),
+    maxsize=int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000")),
+    name="whatsapp",
+)
+
+# One serial lane per conversation (hashed phone number / group id)
+conversation_lanes = LaneExecutor(
+    lanes=int(os.environ.get("CHAT_LANES", "16")),
+    mailbox_depth=int(os.environ.get("CHAT_MAILBOX_DEPTH", "100")),
+    name="chat",
+)
+
+# Pooled keep-alive client for every Graph API call
+graph = GraphClient(
+    max_connections=int(os.environ.get("GRAPH_MAX_CONNECTIONS", "20")),
+    max_concurrency=int(os.environ.get("GRAPH_MAX_CONCURRENCY", "10")),
+    timeout=float(os.environ.get("GRAPH_TIMEOUT", "10")),
+)
+
+# Outbound replies: token bucket per phone-number id, retry on 429/5xx
+outbound = OutboundSender(
+    graph,
+    rate=float(os.environ.get("WHATSAPP_SEND_RATE", "20")),
+    burst=int(os.environ.get("WHATSAPP_SEND_BURST", "40")),
+    max_retries=int(os.environ.get("WHATSAPP_SEND_RETRIES", "4")),
+    coalesce_window=float(os.environ.get("WHATSAPP_NOTICE_WINDOW", "2")),
+)
+
+# Set once partition_chat_logs.sql has been applied
+CHAT_LOGS_PARTITIONED = os.environ.get("CHAT_LOGS_PARTITIONED") == "1"
+
+# Log/memory inserts are batched per table instead of one HTTP insert per message
+write_behind = WriteBehindBuffer(
+    db,
+    interval=float(os.environ.get("WRITE_BEHIND_INTERVAL_MS", "500")) / 1000,
+    max_rows=int(os.environ.get("WRITE_BEHIND_MAX_ROWS", "100")),
+    spool_path=os.environ.get("WRITE_BEHIND_SPOOL", "write_behind_spool.jsonl"),
+    conflict_columns={"group_chat_logs": "id,created_at", "dm_logs": "id,created_at"} if CHAT_LOGS_PARTITIONED else None,
+)
+
+# Payload compaction, per-company retention and monthly archives of the chat logs
+retention = RetentionJob(
+    db,
+    interval=float(os.environ.get("RETENTION_INTERVAL_HOURS", "6")) * 3600,
+    compact_days=int(os.environ.get("RETENTION_COMPACT_DAYS", "30")),
+    archive_months=int(os.environ.get("RETENTION_ARCHIVE_MONTHS", "0")),
+    archive_dir=os.environ.get("RETENTION_ARCHIVE_DIR", "archive"),
+)
+
+# Recent turns per DM / group, served from memory instead of re-reading the logs
+dm_windows = ConversationWindows(
+    window=int(os.environ.get("DM_WINDOW", "6")),
+    maxsize=int(os.environ.get("CONVERSATION_CACHE_SIZE", "5000")),
+)
+group_windows = ConversationWindows(
+    window=int(os.environ.get("GROUP_WINDOW", "15")),
+    maxsize=int(os.environ.get("CONVERSATION_CACHE_SIZE", "5000")),
+)
+
+@app.on_event("startup")
+async def start_background_workers():
+    await graph.start()
+    write_behind.start()
+    memory_index.start()
+    if FACT_EXTRACTION and llm.configured("extract"):
+        fact_extractor.start()
+    await load_company_prompts()
+    if CHAT_LOGS_PARTITIONED:
+        retention.start()
+    conversation_lanes.start()
+    job_queue.start()
+
+@app.on_event("shutdown")
+async def drain_background_workers():
+    drain_timeout = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "20"))
+    # Ingress first: its jobs still push messages into the lanes
+    await job_queue.shutdown(timeout=drain_timeout)
+    await conversation_lanes.shutdown(timeout=drain_timeout)
+    await retention.close()
+    # Lanes are drained, so no new group messages; extract what is still batched
+    await fact_extractor.close()
+    await memory_index.close()
+    # Lanes are done writing; push the last rows out before the DB pool goes away
+    await write_behind.close()
+    await outbound.close()
+    await graph.close()
+    await llm.close()
+    db.shutdown()
+    sink.stop()
+
+@app.get("/stats")
+async def stats():
+    return {
+        "queue": job_queue.stats(),
+        "lanes": conversation_lanes.stats(),
+        "idempotency": idempotency.stats(),
+        "statuses": status_counts,
+        "outbound": outbound.stats(),
+        "media_cache": media_cache.stats(),
+        "db": db.stats(),
+        "write_behind": write_behind.stats(),
+        "retention": retention.stats(),
+        "prompts": prompts.stats(),
+        "context_packing": packer.stats(),
+        "llm_output": output_decoder.stats(),
+        "memory_index": memory_index.stats(),
+        "fact_extractor": fact_extractor.stats(),
+        "llm": llm.stats(),
+        "conversations": {"dm": dm_windows.stats(), "group": group_windows.stats()},
+        "lookups": lookup_cache.stats(),
+        "context": {"cache": company_context_cache.stats(), "assembly_latency": context_latency.summary()},
+        "log": sink.stats(),
+    }
+
+# Clients: one shared async client per provider, bounded and circuit-broken
+deepseek = LLMGateway(
+    "deepseek",
     api_key=os.environ.get("DEEPSEEK_API_KEY"),
-    base_url="https://api.deepseek.com"
+    base_url="https://api.deepseek.com",
+    max_concurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", "8")),
+    timeout=float(os.environ.get("LLM_TIMEOUT", "30")),
+    deadline=float(os.environ.get("LLM_DEADLINE", "60")),
+    max_retries=int(os.environ.get("LLM_RETRIES", "2")),
+    breaker_threshold=int(os.environ.get("LLM_BREAKER_FAILURES", "5")),
+    breaker_cooldown=float(os.environ.get("LLM_BREAKER_COOLDOWN", "30")),
+)
+# Real OpenAI (Whisper, GPT-4o vision), not DeepSeek
+openai_gateway = LLMGateway(
+    "openai",
+    api_key=os.environ.get("OPENAI_API_KEY"),
+    max_concurrency=int(os.environ.get("OPENAI_MAX_CONCURRENCY", "4")),
+    timeout=float(os.environ.get("OPENAI_TIMEOUT", "60")),
+    deadline=float(os.environ.get("OPENAI_DEADLINE", "90")),
+    max_retries=int(os.environ.get("LLM_RETRIES", "2")),
+    breaker_threshold=int(os.environ.get("LLM_BREAKER_FAILURES", "5")),
+    breaker_cooldown=float(os.environ.get("LLM_BREAKER_COOLDOWN", "30")),
 )
 
-supabase: Client = create_client(
-    os.environ.get("NEXT_PUBLIC_SUPABASE_URL", ""),
-    os.environ.get("SUPABASE_SERVICE_KEY", "")
+def build_llm_router() -> LLMRouter:
+    """Providers and routes. Extra OpenAI-compatible providers (another vendor, a local
+    fake server for tests) come from LLM_PROVIDERS, route overrides from LLM_ROUTES:
+      LLM_PROVIDERS='[{"name": "local", "base_url": "http://127.0.0.1:9000/v1", "api_key": "x"}]'
+      LLM_ROUTES='{"chat": {"targets": ["local:fake", "deepseek:deepseek-chat"], "policy": "fastest"}}'
+    """
+    gateways = {"deepseek": deepseek, "openai": openai_gateway}
+    for p in json.loads(os.environ.get("LLM_PROVIDERS") or "[]"):
+        gateways[p["name"]] = LLMGateway(
+            p["name"],
+            api_key=p.get("api_key") or os.environ.get(p.get("api_key_env", "")),
+            base_url=p.get("base_url"),
+            max_concurrency=int(p.get("max_concurrency", 8)),
+            timeout=float(p.get("timeout", 30)),
+            deadline=float(p.get("deadline", 60)),
+            max_retries=int(p.get("max_retries", 2)),
+        )
+
+    chat_targets = ["deepseek:deepseek-chat", "openai:gpt-4o-mini"]
+    slow_ms = float(os.environ.get("LLM_SLOW_MS", "8000"))
+    routes = {
+        "chat": {"targets": chat_targets, "slow_ms": slow_ms},
+        # Someone is waiting on WhatsApp: optionally race a second backend
+        "chat_dm": {"targets": chat_targets, "slow_ms": slow_ms,
+                    "hedge_ms": float(os.environ.get("LLM_DM_HEDGE_MS", "0"))},
+        "extract": {"targets": chat_targets},
+        "vision": {"targets": ["openai:gpt-4o"]},
+        "whisper": {"targets": ["openai:whisper-1"]},
+    }
+    routes.update(json.loads(os.environ.get("LLM_ROUTES") or "{}"))
+
+    router = LLMRouter(gateways)
+    for name, policy in routes.items():
+        router.add_route(name, **policy)
+    return router
+
+llm = build_llm_router()
+
+# Redelivered Meta events are dropped here (memory LRU + optional table)
+idempotency = IdempotencyStore(
+    maxsize=int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "50000")),
+    ttl=float(os.environ.get("IDEMPOTENCY_TTL", str(24 * 3600))),
+    db=db,
+    table=os.environ.get("IDEMPOTENCY_TABLE") or None,
 )
 
 # Models
@@ -58,209 +259,494 @@ class ChatRequest(BaseModel):
     mood: Optional[str] = None
     mode: str = 'mini'
     system_prompt: Optional[str] = None
+    prompt_id: Optional[str] = None # Company prompt registered via POST /prompts
+    stream: bool = False # /analyze answers as server-sent events
     # SaaS Fields
     user_id: Optional[str] = None # For web users to look up profile
 
 # --- SAAS HELPERS ---
+# phone -> profile, user_id -> company_id, code -> company. Misses ("not registered")
+# are cached too, but briefly, so unknown numbers spamming a group cost one read.
+lookup_cache = TTLCache(
+    maxsize=int(os.environ.get("LOOKUP_CACHE_SIZE", "5000")),
+    ttl=float(os.environ.get("LOOKUP_CACHE_TTL", "300")),
+)
+NEGATIVE_LOOKUP_TTL = float(os.environ.get("NEGATIVE_LOOKUP_TTL", "30"))
+
+async def cached_lookup(key: tuple, load):
+    found, value = lookup_cache.lookup(key)
+    if found:
+        return value
+    value = await load()
+    lookup_cache.set(key, value, ttl=None if value is not None else NEGATIVE_LOOKUP_TTL)
+    return value
+
 async def get_profile_by_phone(phone: str):
-    res = supabase.table("profiles").select("*").eq("phone_number", phone).execute()
-    return res.data[0] if res.data else None
+    async def load():
+        res = await db.execute("profiles.by_phone", supabase.table("profiles").select("*").eq("phone_number", phone))
+        return res.data[0] if res.data else None
+    return await cached_lookup(("phone", phone), load)
+
+async def get_company_id_for_user(user_id: str):
+    async def load():
+        res = await db.execute("profiles.by_user_id", supabase.table("profiles").select("company_id").eq("user_id", user_id))
+        return res.data[0]['company_id'] if res.data else None
+    return await cached_lookup(("user", user_id), load)
 
 async def get_company_by_code(code: str):
-    res = supabase.table("companies").select("*").eq("code", code).execute()
-    return res.data[0] if res.data else None
+    async def load():
+        res = await db.execute("companies.by_code", supabase.table("companies").select("*").eq("code", code))
+        return res.data[0] if res.data else None
+    return await cached_lookup(("code", code), load)
 
 async def create_profile(phone: str, company_id: str):
     data = {"phone_number": phone, "company_id": company_id, "role": "worker"}
-    return supabase.table("profiles").insert(data).execute()
+    res = await db.execute("profiles.insert", supabase.table("profiles").insert(data))
+    # Drop the cached "not registered" so the next message sees the new profile
+    lookup_cache.pop(("phone", phone))
+    return res
 
 async def log_group_message(group_id: str, phone: str, content: str, company_id: Optional[str], raw_data: dict):
-    """Logs every group event to the audit trail."""
+    """Logs every group event to the audit trail (batched, see write_behind)."""
+    row = write_behind.add("group_chat_logs", {
+        "group_id": group_id,
+        "sender_phone": phone,
+        "content": content,
+        "company_id": company_id,
+        "raw_payload": raw_data
+    })
+    group_windows.append(group_id, group_turn(phone, content))
+    log("group_msg_logged", group_id=group_id, preview=content[:20])
+    return row
+
+def group_turn(phone: str, content: str) -> dict:
+    """Group messages reach the model as user turns prefixed with the sender."""
+    return {"role": "user", "content": f"[{phone}] {content}"}
+
+async def fetch_group_history(group_id: str, limit: int):
+    """Last N group messages, oldest first (warms group_windows)."""
+    pending = write_behind.pending("group_chat_logs", group_id=group_id)
     try:
-        supabase.table("group_chat_logs").insert({
-            "group_id": group_id,
-            "sender_phone": phone,
-            "content": content,
-            "company_id": company_id,
-            "raw_payload": raw_data
-        }).execute()
-        print(f"Logged Group Msg: {group_id} | {content[:20]}")
+        res = await db.execute("group_chat_logs.history", supabase.table("group_chat_logs")\
+            .select("id, sender_phone, content, created_at")\
+            .eq("group_id", group_id)\
+            .order("created_at", desc=True)\
+            .limit(limit))
+        rows = res.data or []
     except Exception as e:
-        print(f"Log Error: {e}")
+        log("group_history_error", level="error", error=str(e))
+        rows = []
+    return [group_turn(r["sender_phone"], r["content"] or "") for r in merge_pending(rows, pending)[-limit:]]
 
 # --- CORE AI LOGIC (SHARED BRAIN) ---
+MEMORY_FETCH_FAILED = "Hafıza alınamadı."
+HARD_FACTS_FETCH_FAILED = "Resmi veriler şu an alınamadı."
+# Newest finished tasks listed by name; the rest only counted
+HARD_FACTS_TASK_LIMIT = int(os.environ.get("HARD_FACTS_TASK_LIMIT", "20"))
+# Upper bound on rows read; the token budget decides how many reach the prompt
+MEMORY_FETCH_LIMIT = int(os.environ.get("MEMORY_FETCH_LIMIT", "30"))
+
+packer = ContextPacker(
+    facts=int(os.environ.get("CONTEXT_FACTS_TOKENS", "400")),
+    memory=int(os.environ.get("CONTEXT_MEMORY_TOKENS", "800")),
+    history=int(os.environ.get("CONTEXT_HISTORY_TOKENS", "1200")),
+)
+
+# Tolerant JSON decoding of Dayı's answers; asks again only for missing fields
+output_decoder = OutputDecoder(CHAT_SCHEMA, max_retries=int(os.environ.get("LLM_OUTPUT_RETRIES", "1")))
+
 async def fetch_site_memory(company_id: str):
     """Fetches recent site facts for the specific company."""
     if not company_id:
         return "Şirket kaydı bulunamadı. Hafıza kapalı."
     
     try:
-        response = supabase.table("site_memory")\
-            .select("content, created_at, category")\
+        response = await db.execute("site_memory.recent", supabase.table("site_memory")\
+            .select("id, content, created_at, category")\
             .eq("company_id", company_id)\
-            .order("created_at", desc=True).limit(15).execute()
+            .order("created_at", desc=True).limit(MEMORY_FETCH_LIMIT))
         
-        if response.data:
-            return "\n".join([f"- [{m['created_at'][:16]}] {m['content']}" for m in response.data])
+        memories = merge_pending(response.data or [], write_behind.pending("site_memory", company_id=company_id))[-MEMORY_FETCH_LIMIT:]
+        if memories:
+            # Newest first, as many as the memory token budget allows
+            lines = [format_memory(m) for m in reversed(memories)]
+            return "\n".join(packer.pack_lines("memory", lines))
         return "Henüz bir kayıt yok."
     except Exception as e:
-        print(f"Memory Fetch Error: {e}")
-        return "Hafıza alınamadı."
+        log("memory_fetch_error", level="error", error=str(e))
+        return MEMORY_FETCH_FAILED
 
 async def save_site_memory(content: str, company_id: str, category: str = "general"):
     """Saves a new fact to the hivemind for the specific company."""
     if not company_id:
         return
+    row = write_behind.add("site_memory", {
+        "content": content,
+        "category": category,
+        "company_id": company_id
+    })
+    memory_index.add(company_id, row)
+    # fetch_site_memory merges the buffered row, so the next prompt already sees it
+    invalidate_company_context(company_id)
+
+async def load_company_memories(company_id: str, since: Optional[str]) -> List[dict]:
+    """All site_memory rows of a company (or those since `since`), to build its index."""
+    rows = []
+    async for page in keyset_pages(db, "site_memory", "id, content, created_at, category",
+                                   filters={"company_id": company_id}, since=since):
+        rows.extend(page)
+    return merge_pending(rows, write_behind.pending("site_memory", company_id=company_id))
+
+# In-process BM25 (+ optional hashed dense vectors) over each company's site_memory
+memory_index = MemoryIndex(
+    load_company_memories,
+    disk_dir=os.environ.get("MEMORY_INDEX_DIR") or None,
+    maxsize=int(os.environ.get("MEMORY_INDEX_COMPANIES", "200")),
+    dense_dim=int(os.environ.get("MEMORY_INDEX_DENSE_DIM", "0")),
+)
+MEMORY_TOP_K = int(os.environ.get("MEMORY_TOP_K", "8"))
+
+async def save_extracted_facts(company_id: str, facts: List[dict]):
+    """Facts pulled from untriggered group chat; write-behind turns them into one bulk insert."""
+    for fact in facts:
+        row = write_behind.add("site_memory", {
+            "content": fact["content"],
+            "category": fact["category"],
+            "company_id": company_id,
+        })
+        memory_index.add(company_id, row)
+    invalidate_company_context(company_id)
+
+# Untriggered group messages -> one structured extraction call per company batch
+FACT_EXTRACTION = os.environ.get("FACT_EXTRACTION", "1") == "1"
+fact_extractor = FactExtractor(
+    llm,
+    save_extracted_facts,
+    window=float(os.environ.get("FACT_EXTRACT_INTERVAL", "60")),
+    max_tokens=int(os.environ.get("FACT_EXTRACT_MAX_TOKENS", "2000")),
+    max_concurrency=int(os.environ.get("FACT_EXTRACT_CONCURRENCY", "2")),
+)
+
+def format_memory(m: dict) -> str:
+    return f"- [{(m.get('created_at') or '')[:16]}] {m['content']}"
+
+async def compose_memory_context(company_id: Optional[str], recent_context: str, query: str) -> str:
+    """Memories relevant to `query` first, then the newest ones, within the memory budget."""
     try:
-        supabase.table("site_memory").insert({
-            "content": content,
-            "category": category,
-            "company_id": company_id
-        }).execute()
+        hits = await memory_index.search(company_id, query, MEMORY_TOP_K)
     except Exception as e:
-        print(f"Memory Save Error: {e}")
+        log("memory_search_error", level="error", error=str(e))
+        return recent_context
+    if not hits:
+        return recent_context
+    relevant = [format_memory(m) for m in hits]
+    recent = [line for line in recent_context.split("\n") if line.startswith("- [") and line not in relevant]
+    return "\n".join(packer.pack_lines("memory", relevant + recent))
 
 async def fetch_hard_facts(company_id: str):
-    """Fetches STRICT database variables (Budget & Progress). NOT memory."""
+    """Fetches STRICT database variables (Budget & Progress). NOT memory.
+
+    One RPC (add_hard_facts_function.sql): Postgres does the sums and returns a
+    fixed-size JSON, instead of shipping every budget row for each chat message.
+    """
     if not company_id: return "Veri Yok."
     
+    try:
+        res = await db.execute("rpc.company_hard_facts", supabase.rpc("company_hard_facts", {
+            "p_company_id": company_id,
+            "p_task_limit": HARD_FACTS_TASK_LIMIT,
+        }))
+        agg = res.data or {}
+    except Exception as e:
+        log("hard_facts_error", level="error", error=str(e))
+        return HARD_FACTS_FETCH_FAILED
+    
     facts = []
     
     # 1. Budget Status
-    try:
-        b_res = supabase.table("budget_items").select("item_name, total_budget, used_quantity").eq("company_id", company_id).execute()
-        if b_res.data:
-            total_money = sum(item['total_budget'] for item in b_res.data)
-            facts.append(f"- TOPLAM BÜTÇE HEDEFİ: {total_money:,.0f} TL")
-    except: pass
+    if agg.get("budget_items"):
+        planned = float(agg.get("planned_budget") or 0)
+        used = float(agg.get("used_budget") or 0)
+        facts.append(f"- TOPLAM BÜTÇE HEDEFİ: {planned:,.0f} TL")
+        if planned:
+            facts.append(f"- HARCANAN: {used:,.0f} TL (%{used / planned * 100:.1f})")
     
     # 2. Progress Status
-    try:
-        p_res = supabase.table("project_progress").select("status, milestones(task_name, weight_points)").eq("company_id", company_id).eq("status", "completed").execute()
-        if p_res.data:
-             total_pts = sum(d['milestones']['weight_points'] for d in p_res.data if d.get('milestones'))
-             progress_pct = (total_pts / 1000) * 100
-             facts.append(f"- TEYİTLİ İLERLEME: %{progress_pct:.1f}")
-             facts.append(f"- BİTEN İŞLER: {', '.join([d['milestones']['task_name'] for d in p_res.data if d.get('milestones')])}")
-    except: pass
+    if agg.get("finished_count"):
+        total_pts = float(agg.get("total_points") or 1000)
+        progress_pct = (float(agg.get("completed_points") or 0) / total_pts) * 100
+        facts.append(f"- TEYİTLİ İLERLEME: %{progress_pct:.1f}")
+        # Newest first; whatever the numbers above leave of the facts budget
+        task_budget = packer.budgets["facts"] - estimate_tokens("\n".join(facts)) - 20
+        tasks, _ = packer.pack_items("facts", agg.get("finished_tasks") or [], max(task_budget, 0))
+        more = agg["finished_count"] - len(tasks)
+        facts.append(f"- BİTEN İŞLER: {', '.join(tasks)}" + (f" (+{more} iş daha)" if more > 0 else ""))
     
     if not facts: return "Henüz girilmiş resmi veri yok."
     return "\n".join(facts)
 
-async def save_site_memory(content: str, company_id: str):
-    """Saves a new fact/memory to Supabase."""
-    try:
-        data = {
-            "company_id": company_id,
-            "content": content,
-            "category": "general",
-            "created_at": "now()"
-        }
-        supabase.table("site_memory").insert(data).execute()
-    except Exception as e:
-        print(f"Memory Save Error: {e}")
+# --- CONTEXT ASSEMBLY (per-company cache) ---
+# Memory + hard facts only change on our own writes (memory saves, Excel imports)
+# or on progress updates, which call POST /context/invalidate (with X-Admin-Token).
+company_context_cache = TTLCache(
+    maxsize=int(os.environ.get("CONTEXT_CACHE_SIZE", "500")),
+    ttl=float(os.environ.get("CONTEXT_CACHE_TTL", "300")),
+)
+context_latency = LatencyWindow()
+
+async def assemble_company_context(company_id: Optional[str]):
+    """(site_memory_context, hard_facts_context), cached per company, fetched concurrently."""
+    if company_id:
+        found, cached = company_context_cache.lookup(company_id)
+        if found:
+            return cached
+
+    with Timer(context_latency):
+        context = await asyncio.gather(fetch_site_memory(company_id), fetch_hard_facts(company_id))
+
+    if company_id and context[0] != MEMORY_FETCH_FAILED and context[1] != HARD_FACTS_FETCH_FAILED:
+        company_context_cache.set(company_id, tuple(context))
+    return tuple(context)
+
+def invalidate_company_context(company_id: Optional[str]):
+    if company_id:
+        company_context_cache.pop(company_id)
+
+class InvalidateRequest(BaseModel):
+    company_id: str
+
+def require_admin(x_admin_token: Optional[str]):
+    """Admin endpoints need the X-Admin-Token header to match ADMIN_TOKEN (unset = disabled)."""
+    token = os.environ.get("ADMIN_TOKEN")
+    if not token or x_admin_token != token:
+        raise HTTPException(status_code=403, detail="Yetki yok")
+
+@app.post("/context/invalidate")
+async def invalidate_context(request: InvalidateRequest, x_admin_token: Optional[str] = Header(None)):
+    """Hook for writes outside this backend (progress updates from the panel / DB webhook)."""
+    require_admin(x_admin_token)
+    invalidate_company_context(request.company_id)
+    return {"status": "invalidated"}
+
+# --- EXPORTS ---
+@app.get("/export/{table}")
+async def export_logs(table: str, company_id: str, format: str = "ndjson",
+                      since: Optional[str] = None, until: Optional[str] = None,
+                      x_export_token: Optional[str] = Header(None)):
+    """Streams a company's group chat / DM logs / site memory as NDJSON or CSV.
+
+    Keyset-paginated on (created_at, id): constant memory and no OFFSET scans,
+    so a year of logs exports the same way as a day.
+    """
+    token = os.environ.get("EXPORT_TOKEN")
+    if not token or x_export_token != token:
+        raise HTTPException(status_code=403, detail="Export yetkisi yok")
+    if table not in EXPORT_COLUMNS:
+        raise HTTPException(status_code=404, detail="Unknown table")
+    if format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+
+    filename = f"{table}_{company_id}.{format}"
+    return StreamingResponse(
+        stream_export(db, table, company_id, format, since=since, until=until,
+                      page_size=int(os.environ.get("EXPORT_PAGE_SIZE", "1000"))),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 # --- DM HISTORY ---
 async def record_dm(phone: str, company_id: str, role: str, content: str):
     """Logs DM to supabase for history."""
     if not company_id: return
-    try:
-        supabase.table("dm_logs").insert({
-            "phone_number": phone,
-            "company_id": company_id,
-            "role": role,
-            "content": content
-        }).execute()
-    except Exception as e:
-        print(f"DM Log Error (Table missing? Run SQL): {e}")
+    write_behind.add("dm_logs", {
+        "phone_number": phone,
+        "company_id": company_id,
+        "role": role,
+        "content": content
+    })
+    dm_windows.append(phone, {"role": role, "content": content})
+
+def merge_pending(rows: List[dict], pending: List[dict]) -> List[dict]:
+    """DB rows + not-yet-flushed buffer rows, deduped by id, oldest first."""
+    merged = {r["id"]: r for r in rows}
+    merged.update({r["id"]: r for r in pending})
+    return sorted(merged.values(), key=lambda r: r["created_at"])
 
 async def fetch_dm_history(phone: str, limit=5):
-    """Fetches last N messages for context."""
+    """Fetches last N messages for context (read-your-writes through the write-behind buffer)."""
+    pending = write_behind.pending("dm_logs", phone_number=phone)
     try:
-        res = supabase.table("dm_logs").select("role, content")\
+        res = await db.execute("dm_logs.history", supabase.table("dm_logs").select("id, role, content, created_at")\
             .eq("phone_number", phone)\
             .order("created_at", desc=True)\
-            .limit(limit)\
-            .execute()
-        return res.data[::-1] if res.data else []
+            .limit(limit))
+        rows = res.data or []
     except Exception as e:
-        print(f"DM History Fetch Error: {e}")
-        return []
+        log("dm_history_error", level="error", error=str(e), hint="Table missing? Run add_dm_logs.sql")
+        rows = []
+    return [{"role": r["role"], "content": r["content"]} for r in merge_pending(rows, pending)[-limit:]]
+
+# --- PROMPTS ---
+prompts = PromptRegistry(PromptTemplate("dayi", DAYI_PROMPT))
 
-async def process_chat_message(messages: List[dict], company_id: Optional[str], system_prompt: Optional[str] = None):
+async def load_company_prompts():
+    """Compiles every company prompt once at startup (add_company_prompts.sql)."""
     try:
-        # 1. Fetch Contexts
-        site_memory_context = await fetch_site_memory(company_id)
-        hard_facts_context = await fetch_hard_facts(company_id)
-        
-        # 2. Prepare System Prompt
-        from datetime import datetime
-        import pytz
-        tr_time = datetime.now(pytz.timezone('Europe/Istanbul')).strftime('%Y-%m-%d %H:%M')
-
-        base_system_prompt = system_prompt or """### ROLE & PERSONA
-You are the SITE CHIEF (Şantiye Şefi). Your name is "Dayı".
-You speak Turkish. You are experienced, fatherly, strictly professional but warm.
-You manage a construction site.
-
-### CURRENT TIME
-Now is: {CURRENT_TIME} (YYYY-MM-DD HH:MM)
-
-### HARD FACTS (KESİN BİLGİ - DEĞİŞMEZ)
-These are the REAL numbers from the database. Trust these over any memory.
-{HARD_FACTS}
-
-### HIVEMIND (SITE MEMORY - CHAT HISTORY)
-Recent conversations:
-{MEMORY_CONTEXT}
-
-### INSTRUCTIONS
-1. Analyze the user's input.
-2. If the user is REPORTING a new fact (e.g., "Cement finished"), EXTRACT it to 'memory_update'.
-3. If the user is ASKING a question, use the HARD FACTS first, then HIVEMIND.
-4. Give valid, safe, and direct advice.
-5. **VERY IMPORTANT:** BE CONCISE. Do not write long paragraphs. Keep it under 2 sentences if possible. Talk like a busy foreman.
-6. Pay close attention to timestamps. If a memory is from yesterday, say "yesterday".
-
-### OUTPUT FORMAT (JSON)
-{
-  "insight": "Your direct answer to the user.",
-  "risk_score": 0-100,
-  "memory_update": "Extracted new fact or null"
-}
-"""
-        final_system_prompt = base_system_prompt.replace("{MEMORY_CONTEXT}", site_memory_context)\
-                                                .replace("{CURRENT_TIME}", tr_time)\
-                                                .replace("{HARD_FACTS}", hard_facts_context)
-
-        api_messages = [{"role": "system", "content": final_system_prompt}]
-        for msg in messages:
-             # Handle both Pydantic models (from API) and Dicts (from Webhook)
-             if isinstance(msg, dict):
-                 api_messages.append({"role": msg['role'], "content": msg['content']})
-             else:
-                 api_messages.append({"role": msg.role, "content": msg.content})
-
-        response = client.chat.completions.create(
-            model="deepseek-chat",
+        res = await db.execute("company_prompts.all", supabase.table("company_prompts")\
+            .select("company_id, prompt_id, template"))
+        for row in res.data or []:
+            prompts.register(row["company_id"], row["prompt_id"], row["template"])
+        log("company_prompts_loaded", count=len(res.data or []))
+    except Exception as e:
+        log("company_prompts_error", level="warning", error=str(e), hint="Run add_company_prompts.sql")
+
+class PromptRequest(BaseModel):
+    company_id: str
+    prompt_id: str
+    template: str # {HARD_FACTS}, {MEMORY_CONTEXT}, {CURRENT_TIME}; keep them at the end
+
+@app.post("/prompts")
+async def register_prompt(request: PromptRequest, x_admin_token: Optional[str] = Header(None)):
+    """Registers (or replaces) a company's custom system prompt, usable as `prompt_id` in /analyze."""
+    require_admin(x_admin_token)
+    await db.execute("company_prompts.upsert", supabase.table("company_prompts").upsert({
+        "company_id": request.company_id,
+        "prompt_id": request.prompt_id,
+        "template": request.template,
+    }))
+    template = prompts.register(request.company_id, request.prompt_id, request.template)
+    return {"status": "registered", "slots": template.slots, "static_prefix_chars": len(template.static_prefix)}
+
+CIRCUIT_OPEN_REPLY = {"insight": "Merkezle bağlantı koptu yeğenim, birkaç dakikaya tekrar yaz.", "risk_score": 0}
+ERROR_REPLY = {"insight": "Hat çekmiyor yeğenim. Tekrar et.", "risk_score": 0}
+
+async def build_chat_request(messages: List[dict], company_id: Optional[str], system_prompt: Optional[str] = None,
+                             prompt_id: Optional[str] = None):
+    """(template, api_messages) for one Dayı completion."""
+    # 1. Fetch Contexts (concurrently, cached per company)
+    site_memory_context, hard_facts_context = await assemble_company_context(company_id)
+    query = next((m["content"] if isinstance(m, dict) else m.content
+                  for m in reversed(messages) if (m["role"] if isinstance(m, dict) else m.role) == "user"), "")
+    site_memory_context = await compose_memory_context(company_id, site_memory_context, query)
+    
+    # 2. Prepare System Prompt
+    from datetime import datetime
+    import pytz
+    tr_time = datetime.now(pytz.timezone('Europe/Istanbul')).strftime('%Y-%m-%d %H:%M')
+
+    template = prompts.resolve(company_id, prompt_id, system_prompt)
+    final_system_prompt = template.render(
+        HARD_FACTS=hard_facts_context,
+        MEMORY_CONTEXT=site_memory_context,
+        CURRENT_TIME=tr_time,
+    )
+
+    history = []
+    for msg in messages:
+         # Handle both Pydantic models (from API) and Dicts (from Webhook)
+         if isinstance(msg, dict):
+             history.append({"role": msg['role'], "content": msg['content']})
+         else:
+             history.append({"role": msg.role, "content": msg.content})
+    history = packer.pack_history(history)
+
+    packer.record(
+        system=estimate_tokens(final_system_prompt) - estimate_tokens(hard_facts_context) - estimate_tokens(site_memory_context),
+        facts=estimate_tokens(hard_facts_context),
+        memory=estimate_tokens(site_memory_context),
+        history=sum(estimate_tokens(m["content"]) for m in history),
+    )
+    return template, [{"role": "system", "content": final_system_prompt}] + history
+
+async def apply_memory_update(result: dict, company_id: Optional[str]):
+    # 3. Save New Memory if detected
+    if result.get("memory_update") and company_id:
+        log("memory_detected", company_id=company_id, memory=result['memory_update'])
+        await save_site_memory(result['memory_update'], company_id)
+
+def missing_fields_request(route: str, api_messages: List[dict]):
+    """`ask` for output_decoder: same conversation plus the broken answer, only the missing fields back."""
+    async def ask(missing: List[str], broken: str) -> str:
+        response = await llm.call(route, lambda model: lambda c: c.chat.completions.create(
+            model=model,
+            messages=api_messages + [
+                {"role": "assistant", "content": broken or "{}"},
+                {"role": "user", "content": missing_fields_prompt(missing)},
+            ],
+            temperature=0.2,
+            response_format={'type': 'json_object'}
+        ))
+        return response.choices[0].message.content
+    return ask
+
+async def process_chat_message(messages: List[dict], company_id: Optional[str], system_prompt: Optional[str] = None,
+                               prompt_id: Optional[str] = None, route: str = "chat"):
+    try:
+        template, api_messages = await build_chat_request(messages, company_id, system_prompt, prompt_id)
+
+        started = time.perf_counter()
+        response = await llm.call(route, lambda model: lambda c: c.chat.completions.create(
+            model=model,
             messages=api_messages,
             temperature=0.4,
             response_format={'type': 'json_object'}
-        )
+        ))
+        prompts.record(template, getattr(response, "usage", None), time.perf_counter() - started)
         
         content = response.choices[0].message.content
-        result = json.loads(content)
-        
-        # 3. Save New Memory if detected
-        if result.get("memory_update") and company_id:
-            print(f"New Memory Detected for {company_id}: {result['memory_update']}")
-            await save_site_memory(result['memory_update'], company_id)
-
+        result = await output_decoder.complete(content, missing_fields_request(route, api_messages))
+        await apply_memory_update(result, company_id)
         return result
 
+    except CircuitOpen:
+        # Provider is down; answer immediately instead of queueing behind timeouts
+        return dict(CIRCUIT_OPEN_REPLY)
+    except Exception as e:
+        log("ai_process_error", level="error", error=str(e))
+        return dict(ERROR_REPLY)
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def stream_chat_message(messages: List[dict], company_id: Optional[str], system_prompt: Optional[str] = None,
+                              prompt_id: Optional[str] = None):
+    """SSE variant of process_chat_message.
+
+    `insight` events carry the answer text as the tokens arrive; one final `done`
+    event carries the whole result. The memory save runs only after the stream ends.
+    """
+    parser = JSONFieldStream(streamed=("insight",))
+    try:
+        template, api_messages = await build_chat_request(messages, company_id, system_prompt, prompt_id)
+
+        started = time.perf_counter()
+        usage = None
+        async for chunk in llm.stream("chat", lambda model: lambda c: c.chat.completions.create(
+            model=model,
+            messages=api_messages,
+            temperature=0.4,
+            response_format={'type': 'json_object'},
+            stream=True,
+            stream_options={"include_usage": True},
+        )):
+            usage = getattr(chunk, "usage", None) or usage
+            if not chunk.choices:
+                continue
+            for _, delta in parser.feed(chunk.choices[0].delta.content or ""):
+                yield sse("insight", {"delta": delta})
+        prompts.record(template, usage, time.perf_counter() - started)
+
+        # A cleanly closed stream was already parsed field by field; only a broken one is re-decoded
+        result = await output_decoder.complete(parser.content, missing_fields_request("chat", api_messages),
+                                               parsed=parser.values if parser.closed else None)
+        await apply_memory_update(result, company_id)
+        yield sse("done", result)
+
+    except CircuitOpen:
+        yield sse("done", CIRCUIT_OPEN_REPLY)
     except Exception as e:
-        print(f"AI Process Error: {str(e)}")
-        return {"insight": "Hat çekmiyor yeğenim. Tekrar et.", "risk_score": 0}
+        log("ai_stream_error", level="error", error=str(e))
+        yield sse("error", ERROR_REPLY)
 
 @app.get("/")
 def read_root():
@@ -273,17 +759,21 @@ async def analyze_sentiment(request: ChatRequest):
     
     company_id = None
     if request.user_id:
-        # Look up profile
-        res = supabase.table("profiles").select("company_id").eq("user_id", request.user_id).execute()
-        if res.data:
-            company_id = res.data[0]['company_id']
+        # Look up profile (cached)
+        company_id = await get_company_id_for_user(request.user_id)
     
     # Fallback to a 'DEMO' logic or just run without memory if no company
     # But for 'Hivemind' to work we need a company.
     # We'll allow running without company_id (Memory will be "Closed")
     
     msgs = [{"role": m.role, "content": m.content} for m in request.messages]
-    return await process_chat_message(msgs, company_id, request.system_prompt)
+    if request.stream:
+        return StreamingResponse(
+            stream_chat_message(msgs, company_id, request.system_prompt, request.prompt_id),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    return await process_chat_message(msgs, company_id, request.system_prompt, request.prompt_id)
 
 
 # --- WHATSAPP WEBHOOK (SAAS ONBOARDING) ---
@@ -300,135 +790,131 @@ async def verify_whatsapp(request: Request):
     
     if mode and verify_token:
         if mode == "subscribe" and verify_token == token:
-            print("WEBHOOK_VERIFIED")
+            log("webhook_verified")
             return int(challenge)
         else:
             raise HTTPException(status_code=403, detail="Verification failed")
     
     return {"status": "Hello WhatsApp"}
 
-import requests
-
-# ... helpers ...
-
-async def send_whatsapp_message(to_number: str, message: str):
+def whatsapp_phone_id() -> Optional[str]:
     phone_id = os.environ.get("WHATSAPP_PHONE_ID")
-    token = os.environ.get("WHATSAPP_API_TOKEN")
-    
-    if not phone_id or not token:
-        print("WhatsApp Credentials missing")
-        return
+    if not phone_id or not os.environ.get("WHATSAPP_API_TOKEN"):
+        log("whatsapp_credentials_missing", level="warning")
+        return None
+    return phone_id
 
-    url = f"https://graph.facebook.com/v17.0/{phone_id}/messages"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "messaging_product": "whatsapp",
-        "to": to_number,
-        "type": "text",
-        "text": {"body": message}
-    }
-    
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        
-        # Log Response
-        with open("webhook_debug.log", "a", encoding="utf-8") as f:
-            f.write(f"Send Status: {response.status_code}\n")
-            f.write(f"Send Response: {response.text}\n")
-            
-        if response.status_code != 200:
-            print(f"Failed to send message: {response.text}")
-    except Exception as e:
-        with open("webhook_debug.log", "a", encoding="utf-8") as f:
-            f.write(f"Send ErrorException: {e}\n")
-        print(f"Error sending WhatsApp: {e}")
+async def send_whatsapp_message(to_number: str, message: str):
+    """Sends a reply (rate-limited, retried). Replaces any still-pending progress notice."""
+    phone_id = whatsapp_phone_id()
+    if phone_id:
+        await outbound.send(phone_id, to_number, message)
 
-# ... webhook ...
+def send_whatsapp_notice(to_number: str, message: str):
+    """Progress notice ("dinleniyor..."): only delivered if the answer takes a while."""
+    phone_id = whatsapp_phone_id()
+    if phone_id:
+        outbound.notify(phone_id, to_number, message)
 
 # --- MEDIA HANDLERS ---
-async def download_whatsapp_media(media_id: str):
-    """Downloads media file from WhatsApp Cloud API."""
+# Whisper/GPT-4o results by content hash: forwarded media costs one model call
+media_cache = MediaAnalysisCache(
+    maxsize=int(os.environ.get("MEDIA_CACHE_SIZE", "2000")),
+    ttl=float(os.environ.get("MEDIA_CACHE_TTL", str(7 * 24 * 3600))),
+    disk_dir=os.environ.get("MEDIA_CACHE_DIR") or None,
+    disk_max_bytes=int(os.environ.get("MEDIA_CACHE_DISK_BYTES", str(50 * 1024 * 1024))),
+)
+
+async def download_whatsapp_media(media_id: str) -> Optional[MediaFile]:
+    """Streams a media file from WhatsApp Cloud API into a spooled in-memory buffer.
+
+    The caller owns the returned MediaFile and must close() it.
+    """
     token = os.environ.get("WHATSAPP_API_TOKEN")
     if not token: 
         return None
 
     # 1. Get Media URL
-    url = f"https://graph.facebook.com/v17.0/{media_id}"
-    headers = {"Authorization": f"Bearer {token}"}
+    url = f"{GRAPH_API_URL}/{media_id}"
     
+    media = None
     try:
-        r = requests.get(url, headers=headers)
+        r = await graph.request("GET", url)
         if r.status_code != 200:
-            print(f"Media URL Error: {r.text}")
+            log("media_url_error", level="error", media_id=media_id, status=r.status_code, body=r.text[:300])
             return None
         
-        media_url = r.json().get("url")
+        meta = r.json()
+        check_declared_size(meta.get("file_size"))
+        media = MediaFile(media_id, meta.get("mime_type", ""))
         
-        # 2. Download Content
-        r_media = requests.get(media_url, headers=headers)
-        if r_media.status_code != 200:
-            print(f"Media Download Error: {r_media.text}")
-            return None
+        # 2. Stream Content (chunks straight into the buffer, aborts past MEDIA_MAX_BYTES)
+        # Media files are bigger than API calls: allow a longer read
+        async with graph.stream("GET", meta.get("url"), timeout=60.0) as r_media:
+            if r_media.status_code != 200:
+                log("media_download_error", level="error", media_id=media_id, status=r_media.status_code)
+                media.close()
+                return None
+            check_declared_size(r_media.headers.get("content-length"))
+            async for chunk in r_media.aiter_bytes():
+                media.write(chunk)
             
-        # Save to temp file
-        file_path = f"temp_{media_id}.ogg"
-        with open(file_path, "wb") as f:
-            f.write(r_media.content)
-            
-        return file_path
+        return media
+    except MediaTooLarge as e:
+        log("media_too_large", level="warning", media_id=media_id, error=str(e))
     except Exception as e:
-        print(f"Download Exception: {e}")
-        return None
+        log("media_download_exception", level="error", media_id=media_id, error=str(e))
+    if media:
+        media.close()
+    return None
 
-async def transcribe_audio(file_path: str):
+async def transcribe_audio(media: MediaFile):
     """Transcribes audio using OpenAI Whisper."""
-    api_key = os.environ.get("OPENAI_API_KEY") # Needs real OpenAI key, not DeepSeek
-    if not api_key:
-        print("OPENAI_API_KEY missing for simple transcription")
+    if not llm.configured("whisper"): # Needs real OpenAI key, not DeepSeek
+        log("openai_key_missing", level="warning", feature="transcription")
+        media.close()
         return "(Sesli mesaj çözülemedi - API Key yok)"
         
     try:
-        # We need a native OpenAI client here, distinct from the DeepSeek one
-        from openai import OpenAI as RealOpenAI
-        voice_client = RealOpenAI(api_key=api_key)
-        
-        with open(file_path, "rb") as audio_file:
-            transcription = voice_client.audio.transcriptions.create(
-                model="whisper-1", 
-                file=audio_file,
-                language="tr" # Force Turkish for better accuracy with "Dayı" jargon
-            )
+        # Same voice note forwarded to several groups = one Whisper call
+        cached = await media_cache.get("transcript", media)
+        if cached is not None:
+            return cached
+
+        # rewind() inside the lambda: a retry re-reads the file from the start
+        transcription = await llm.call("whisper", lambda model: lambda c: c.audio.transcriptions.create(
+            model=model, 
+            file=(media.filename, media.rewind()),
+            language="tr" # Force Turkish for better accuracy with "Dayı" jargon
+        ))
+        await media_cache.put("transcript", media, transcription.text)
         return transcription.text
     except Exception as e:
-        print(f"Whisper Error: {e}")
+        log("whisper_error", level="error", error=str(e))
         return "(Sesli mesaj anlaşılamadı)"
     finally:
-        # Cleanup
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        media.close()
 
 # --- IMAGE ANALYSIS (GPT-4o) ---
-def encode_image(image_path):
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+def encode_image(media: MediaFile):
+    return base64.b64encode(media.read()).decode('utf-8')
 
-async def analyze_image_with_gpt4o(image_path: str):
+async def analyze_image_with_gpt4o(media: MediaFile):
     """Analyzes construction site images using GPT-4o Vision."""
-    api_key = os.environ.get("OPENAI_API_KEY")
-    if not api_key:
+    if not llm.configured("vision"):
+        media.close()
         return "(Görsel analizi yapılamadı - API Key eksik)"
 
     try:
-        from openai import OpenAI
-        client = OpenAI(api_key=api_key)
+        cached = await media_cache.get("vision", media)
+        if cached is not None:
+            return cached
 
-        base64_image = encode_image(image_path)
+        base64_image = encode_image(media)
+        image_mime = media.mime_type if media.mime_type.startswith("image/") else "image/jpeg"
 
-        response = client.chat.completions.create(
-            model="gpt-4o",
+        response = await llm.call("vision", lambda model: lambda c: c.chat.completions.create(
+            model=model,
             messages=[
                 {
                     "role": "system",
@@ -441,38 +927,86 @@ async def analyze_image_with_gpt4o(image_path: str):
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
+                                "url": f"data:{image_mime};base64,{base64_image}"
                             }
                         }
                     ]
                 }
             ],
             max_tokens=300
-        )
-        return response.choices[0].message.content
+        ))
+        report = response.choices[0].message.content
+        await media_cache.put("vision", media, report)
+        return report
     except Exception as e:
-        print(f"Vision Error: {e}")
+        log("vision_error", level="error", error=str(e))
         return "(Görsel analizinde hata oluştu)"
     finally:
-        if os.path.exists(image_path):
-            os.remove(image_path)
+        media.close()
 
 
 @app.post("/whatsapp")
 async def whatsapp_webhook(request: dict):
-    with open("webhook_debug.log", "a", encoding="utf-8") as f:
-        f.write(f"\n--- NEW REQUEST ---\n{json.dumps(request, indent=2)}\n")
-    
+    """Validates and enqueues the Meta payload. The pipeline runs in the job queue."""
+    new_correlation_id()
+    sink.payload("webhook_received", request, entries=len(request.get("entry") or []))
+
+    if not isinstance(request.get("entry"), list) or not request["entry"]:
+        return {"status": "ignored"}
+
+    event_keys = webhook_event_keys(request)
+    new_keys = idempotency.filter_new(event_keys)
+    if event_keys and not new_keys:
+        return {"status": "duplicate"}
+
+    if not job_queue.submit(handle_whatsapp_event, request, set(new_keys)):
+        # Non-200 makes Meta redeliver later instead of us dropping the message
+        raise HTTPException(status_code=503, detail="Queue full")
+
+    # Marked only after a successful enqueue so a 503'd delivery is processed on retry
+    idempotency.mark(new_keys)
+    return {"status": "queued"}
+
+
+status_counts = {}
+
+async def handle_whatsapp_event(request: dict, new_keys: set):
+    """Walks every entry/change/message of a Meta delivery. Runs on a job queue worker.
+
+    Meta batches several messages (and statuses) into one POST when it is busy.
+    Each message goes to its conversation's lane: one conversation is processed
+    strictly in order, different conversations run concurrently.
+    """
+    for entry in request.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+
+            for status in value.get("statuses") or []:
+                if f"status:{status.get('id')}:{status.get('status', '')}" in new_keys:
+                    handle_status_update(status)
+
+            for message_data in value.get("messages") or []:
+                # Payloads without an id (local tests) are never deduped
+                if message_data.get("id") and f"msg:{message_data['id']}" not in new_keys:
+                    continue
+                conversation = message_data.get("group_id") or message_data.get("from")
+                await conversation_lanes.submit(conversation, handle_whatsapp_message, message_data)
+
+
+def handle_status_update(status: dict):
+    """Cheap path for sent/delivered/read/failed receipts: count, log failures only."""
+    kind = status.get("status", "unknown")
+    status_counts[kind] = status_counts.get(kind, 0) + 1
+    if kind == "failed":
+        log("delivery_failed", level="warning", recipient=status.get('recipient_id'), errors=status.get('errors'))
+
+
+async def handle_whatsapp_message(message_data: dict):
+    """Full message pipeline (media, AI, DB, reply) for a single inbound message."""
     try:
-        # Check if it's a Message (not a status update)
-        entry = request.get("entry", [])[0]
-        changes = entry.get("changes", [])[0]
-        value = changes.get("value", {})
-        
-        if "messages" not in value:
-            return {"status": "ignored"}
+        if message_data.get("id") and not await idempotency.claim(f"msg:{message_data['id']}"):
+            return {"status": "duplicate"}
 
-        message_data = value.get("messages", [])[0]
         phone_number = message_data.get("from")
         msg_type = message_data.get("type")
         
@@ -487,18 +1021,17 @@ async def whatsapp_webhook(request: dict):
             is_audio = True
             audio_id = message_data.get("audio", {}).get("id")
             # Notify user we are listening
-            await send_whatsapp_message(phone_number, "🎧 Sesli mesajın dinleniyor usta...")
+            send_whatsapp_notice(phone_number, "🎧 Sesli mesajın dinleniyor usta...")
             
             # Download & Transcribe
-            file_path = await download_whatsapp_media(audio_id)
-            if file_path:
-                transcript = await transcribe_audio(file_path)
+            media = await download_whatsapp_media(audio_id)
+            if media:
+                transcript = await transcribe_audio(media)
                 text_body = transcript
                 # Prefix to let AI know it was audio
                 text_body = f"[SESLİ MESAJ]: {text_body}"
                 
-                with open("webhook_debug.log", "a", encoding="utf-8") as f:
-                    f.write(f"Audio Transcribed: {text_body}\n")
+                log("audio_transcribed", level="debug", message_id=message_data.get("id"), text=text_body)
             else:
                 text_body = "(Ses dosyası indirilemedi)"
 
@@ -506,17 +1039,11 @@ async def whatsapp_webhook(request: dict):
         elif msg_type == "image":
             # HANDLE IMAGE
             image_id = message_data.get("image", {}).get("id")
-            await send_whatsapp_message(phone_number, "📸 Fotoğrafı inceliyorum dayı, bekle...")
+            send_whatsapp_notice(phone_number, "📸 Fotoğrafı inceliyorum dayı, bekle...")
             
-            file_path = await download_whatsapp_media(image_id)
-            if file_path:
-                # Rename to ensure extension (WhatsApp sometimes gives .jpg, sometimes random)
-                if not file_path.endswith((".jpg", ".jpeg", ".png")):
-                    new_path = file_path + ".jpg"
-                    os.rename(file_path, new_path)
-                    file_path = new_path
-                
-                analysis_report = await analyze_image_with_gpt4o(file_path)
+            media = await download_whatsapp_media(image_id)
+            if media:
+                analysis_report = await analyze_image_with_gpt4o(media)
                 
                 # Reply directly with analysis
                 await send_whatsapp_message(phone_number, f"👁️ **Saha Analizi:**\n\n{analysis_report}")
@@ -533,25 +1060,21 @@ async def whatsapp_webhook(request: dict):
             # Check if Excel
             if "sheet" in mime_type or ".xlsx" in file_name:
                 doc_id = doc_data.get("id")
-                await send_whatsapp_message(phone_number, "📊 Excel dosyası inceleniyor...")
+                send_whatsapp_notice(phone_number, "📊 Excel dosyası inceleniyor...")
                 
-                file_path = await download_whatsapp_media(doc_id)
-                if file_path:
-                    # RENAME to .xlsx for pandas to recognize it (WhatsApp downloads as random hash)
-                    new_path = file_path + ".xlsx"
-                    os.rename(file_path, new_path)
-                    
-                    profile = await get_profile_by_phone(phone_number)
-                    if profile:
-                        company_id = profile['company_id']
-                        report = process_budget_excel(new_path, company_id)
-                        reply_text = report
-                    else:
-                        reply_text = "Önce sisteme kayıt olman lazım patron."
-                    
-                    # Cleanup AND prevent AI processing chat on this turn
-                    if os.path.exists(new_path):
-                         os.remove(new_path)
+                media = await download_whatsapp_media(doc_id)
+                if media:
+                    with media:
+                        profile = await get_profile_by_phone(phone_number)
+                        if profile:
+                            company_id = profile['company_id']
+                            # pandas reads the spooled buffer directly, no .xlsx rename needed
+                            # (parsed in a worker thread, inserted through the db pool)
+                            report = await process_budget_excel(media.rewind(), company_id)
+                            invalidate_company_context(company_id)
+                            reply_text = report
+                        else:
+                            reply_text = "Önce sisteme kayıt olman lazım patron."
                     
                     # DIRECTLY RETURN. Do not let AI chat reply.
                     await send_whatsapp_message(phone_number, reply_text)
@@ -562,12 +1085,11 @@ async def whatsapp_webhook(request: dict):
                  return {"status": "ignored_non_excel"}
 
         else:
-            print(f"Unsupported message type: {msg_type}")
+            log("unsupported_message_type", msg_type=msg_type)
             return {"status": "ignored"} # Ignore images/videos for now
 
         
-        with open("webhook_debug.log", "a", encoding="utf-8") as f:
-            f.write(f"Processing: From={phone_number}, Text={text_body}\n")
+        log("processing_message", level="debug", message_id=message_data.get("id"), sender=phone_number, text=text_body)
 
         # 1. Check Profile & Context
         profile = await get_profile_by_phone(phone_number)
@@ -579,7 +1101,7 @@ async def whatsapp_webhook(request: dict):
             company_id = profile['company_id'] if profile else None
             
             # Log with raw payload (includes audio ID if any)
-            await log_group_message(group_id, phone_number, text_body, company_id, message_data)
+            logged = await log_group_message(group_id, phone_number, text_body, company_id, message_data)
             
             # 2. Decide to Reply
             triggers = ["@santiye", "#dayı", "#soru", "!"]
@@ -597,19 +1119,22 @@ async def whatsapp_webhook(request: dict):
                 if not company_id:
                      reply_text = "Bu grubu tanımıyorum yeğenim. Önce özelden bana yazıp kaydol."
                 else:
-                    # Remove trigger prefix/keywords roughly for cleaner AI processing logic or keep relevant
-                    clean_text = text_body
-                    result = await process_chat_message([{"role": "user", "content": clean_text}], company_id)
+                    # The window already ends with this message (logged above), so the
+                    # answer sees what the group was talking about
+                    window = await group_windows.get(group_id, lambda: fetch_group_history(group_id, group_windows.window))
+                    result = await process_chat_message(window, company_id)
                     reply_text = result['insight']
+                    group_windows.append(group_id, {"role": "assistant", "content": reply_text})
             else:
+                if company_id and fact_extractor.task:
+                    fact_extractor.add(company_id, phone_number, text_body, logged["created_at"])
                 return {"status": "logged_group_msg"}
 
         # --- DM (DIRECT MESSAGE) LOGIC ---
         else: 
             reply_text = ""
             if not profile:
-                with open("webhook_debug.log", "a", encoding="utf-8") as f:
-                     f.write("User not found. Checking code.\n")
+                log("unknown_sender", sender=phone_number)
                 
                 if text_body.startswith("#"):
                     code = text_body
@@ -631,29 +1156,18 @@ async def whatsapp_webhook(request: dict):
                 # 1. LOG USER MESSAGE
                 await record_dm(phone_number, company_id, "user", text_body)
                 
-                # 2. FETCH HISTORY
-                history = await fetch_dm_history(phone_number, limit=6)
-                
-                # 3. APPEND CURRENT MESSAGE (if not already in history, usually it's not if we just inserted? 
-                # Actually we just inserted it. So 'history' might include it if we are fast enough, or not.
-                # To be safe: Filter out duplicates or just rely on 'history' + 'current' logic.
-                # 'fetch_dm_history' gets from DB. If 'record_dm' is slow/async, it might not be there.
-                # Let's assume we pass HISTORY + CURRENT manually to be safe.
-                # Actually, standard practice: Pass `history` (excluding current if possible) + `current`.
-                
-                # Let's construct the messages list properly from history
-                chat_messages = []
-                for h in history:
-                    # Skip if it's the exact same message we just sent? No, timestamps differ usually.
-                    chat_messages.append({"role": h['role'], "content": h['content']})
+                # 2. FETCH HISTORY (in-memory window, warmed from dm_logs on a miss)
+                history = await dm_windows.get(phone_number, lambda: fetch_dm_history(phone_number, limit=dm_windows.window))
                 
-                # If the last message in history is NOT the current text (due to lag), append current.
-                # If it IS current, don't append.
-                # Simple hack: Just append current text only if history is empty or last item != current
+                # 3. BUILD CONTEXT
+                # This conversation's lane is serial and history merges the write-behind
+                # buffer, so it already ends with the current message and no other turn
+                # of this number runs in between. The append is only a safety net.
+                chat_messages = [{"role": h['role'], "content": h['content']} for h in history]
                 if not chat_messages or chat_messages[-1]['content'] != text_body:
                      chat_messages.append({"role": "user", "content": text_body})
                 
-                result = await process_chat_message(chat_messages, company_id)
+                result = await process_chat_message(chat_messages, company_id, route="chat_dm")
                 reply_text = result['insight']
                 
                 # 4. LOG ASSISTANT REPLY
@@ -666,9 +1180,7 @@ async def whatsapp_webhook(request: dict):
         return {"status": "processed"}
         
     except Exception as e:
-        with open("webhook_debug.log", "a", encoding="utf-8") as f:
-             f.write(f"CRITICAL ERROR: {e}\n")
-        print(f"WhatsApp Error: {e}")
+        log("whatsapp_handler_error", level="error", message_id=message_data.get("id"), error=str(e))
         return {"status": "error"}
 
 
@@ -0,0 +1,79 @@
+import hashlib
+import mimetypes
+import os
+import tempfile
+from typing import BinaryIO, Optional
+
+# Below this size media stays in RAM; above it the buffer spills to MEDIA_TMP_DIR
+MEDIA_SPOOL_BYTES = int(os.environ.get("MEDIA_SPOOL_BYTES", str(4 * 1024 * 1024)))
+# Whisper rejects files over 25 MB, no point downloading more than that
+MEDIA_MAX_BYTES = int(os.environ.get("MEDIA_MAX_BYTES", str(25 * 1024 * 1024)))
+MEDIA_TMP_DIR = os.environ.get("MEDIA_TMP_DIR") or tempfile.gettempdir()
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+class MediaFile:
+    """Downloaded WhatsApp media held in a spooled buffer instead of temp_<id>.ogg in the CWD.
+
+    Consumers (Whisper, GPT-4o, pandas) get a file-like object via `rewind()`;
+    nothing is written to disk unless the file is bigger than MEDIA_SPOOL_BYTES.
+    """
+
+    def __init__(self, media_id: str, mime_type: str = "", max_bytes: int = MEDIA_MAX_BYTES):
+        self.media_id = media_id
+        self.mime_type = (mime_type or "application/octet-stream").split(";")[0].strip()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        self.phash = None  # filled lazily by media_cache for images
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_BYTES, dir=MEDIA_TMP_DIR)
+
+    @property
+    def filename(self) -> str:
+        # Whisper/openpyxl look at the extension, WhatsApp ids have none
+        ext = mimetypes.guess_extension(self.mime_type) or ""
+        if self.mime_type.startswith("audio/ogg"):
+            ext = ".ogg"
+        return f"{self.media_id}{ext}"
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise MediaTooLarge(f"{self.media_id} exceeds {self.max_bytes} bytes")
+        self.hasher.update(chunk)
+        self.buffer.write(chunk)
+
+    @property
+    def sha256(self) -> str:
+        """Content address of the bytes written so far (computed while streaming)."""
+        return self.hasher.hexdigest()
+
+    def rewind(self) -> BinaryIO:
+        self.buffer.seek(0)
+        return self.buffer
+
+    def read(self) -> bytes:
+        return self.rewind().read()
+
+    @property
+    def spilled(self) -> bool:
+        return bool(getattr(self.buffer, "_rolled", False))
+
+    def close(self):
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def check_declared_size(declared: Optional[str], max_bytes: int = MEDIA_MAX_BYTES):
+    """Aborts before downloading when Meta/the CDN already tells us the file is too big."""
+    if declared and str(declared).isdigit() and int(declared) > max_bytes:
+        raise MediaTooLarge(f"declared size {declared} exceeds {max_bytes} bytes")
@@ -0,0 +1,190 @@
+import asyncio
+import io
+import json
+import os
+import time
+from typing import List, Optional, Tuple
+
+from log_sink import log
+from ttl_cache import TTLCache
+
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# Two images whose dHash differs in at most this many bits are "the same photo"
+PHASH_MAX_DISTANCE = int(os.environ.get("MEDIA_PHASH_MAX_DISTANCE", "4"))
+
+
+def image_dhash(data: bytes, size: int = 8) -> Optional[int]:
+    """64-bit difference hash; survives WhatsApp re-compression of forwarded photos."""
+    if not PIL_AVAILABLE:
+        return None
+    try:
+        img = Image.open(io.BytesIO(data)).convert("L").resize((size + 1, size))
+        px = list(img.getdata())
+        bits = 0
+        for row in range(size):
+            for col in range(size):
+                left = px[row * (size + 1) + col]
+                right = px[row * (size + 1) + col + 1]
+                bits = (bits << 1) | (1 if left > right else 0)
+        return bits
+    except Exception as e:
+        log("dhash_error", level="warning", error=str(e))
+        return None
+
+
+class MediaAnalysisCache:
+    """Transcripts and vision reports keyed by the SHA-256 of the media bytes.
+
+    Tier 1: in-memory LRU+TTL. Tier 2: JSON files in `disk_dir`, oldest evicted
+    once the directory passes `disk_max_bytes` (tracked as a running total, so
+    the directory is only scanned when over budget). Images also match by dHash
+    so a re-encoded forward of the same site photo is still a hit. Image decoding
+    and file I/O run in worker threads.
+    """
+
+    def __init__(self, maxsize: int = 2000, ttl: float = 7 * 24 * 3600,
+                 disk_dir: Optional[str] = None, disk_max_bytes: int = 50 * 1024 * 1024):
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        # sha256 -> dHash of recent images, scanned for near matches
+        self.phashes = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "phash_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self.disk_bytes = 0
+        self.disk_entries = 0
+        self.evicting = False
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            files = self._disk_files()
+            self.disk_entries = len(files)
+            self.disk_bytes = sum(e.stat().st_size for e in files)
+
+    # --- lookup ---
+    async def get(self, kind: str, media) -> Optional[str]:
+        result, tier = await self._get_exact(kind, media.sha256)
+        if result is None and kind == "vision":
+            near = await self._near_image(media)
+            if near:
+                result, _ = await self._get_exact(kind, near)
+                tier = "phash" if result is not None else None
+        self.counters[f"{tier}_hits" if tier else "misses"] += 1
+        return result
+
+    async def _get_exact(self, kind: str, sha: str):
+        key = f"{kind}:{sha}"
+        found, value = self.memory.lookup(key)
+        if found:
+            return value, "memory"
+        if not self.disk_dir:
+            return None, None
+        value, expired_bytes = await asyncio.to_thread(self._disk_read, key)
+        if expired_bytes:
+            self.disk_bytes -= expired_bytes
+            self.disk_entries -= 1
+        if value is not None:
+            self.memory.set(key, value)
+            return value, "disk"
+        return None, None
+
+    async def _near_image(self, media) -> Optional[str]:
+        dhash = await asyncio.to_thread(lambda: image_dhash(media.read()))
+        media.phash = dhash
+        if dhash is None:
+            return None
+        for other_sha, (_, other_hash) in list(self.phashes.data.items()):
+            if bin(dhash ^ other_hash).count("1") <= PHASH_MAX_DISTANCE:
+                return other_sha
+        return None
+
+    # --- store ---
+    async def put(self, kind: str, media, result: str):
+        key = f"{kind}:{media.sha256}"
+        self.memory.set(key, result)
+        self.counters["stores"] += 1
+        if self.disk_dir:
+            added_bytes, added_entries = await asyncio.to_thread(self._disk_write, key, result)
+            self.disk_bytes += added_bytes
+            self.disk_entries += added_entries
+            if self.disk_bytes > self.disk_max_bytes and not self.evicting:
+                self.evicting = True
+                try:
+                    self.disk_bytes, self.disk_entries, evicted = await asyncio.to_thread(self._disk_evict)
+                    self.counters["evictions"] += evicted
+                finally:
+                    self.evicting = False
+        if kind == "vision":
+            dhash = getattr(media, "phash", None)
+            if dhash is None:
+                dhash = await asyncio.to_thread(lambda: image_dhash(media.read()))
+            if dhash is not None:
+                self.phashes.set(media.sha256, dhash)
+
+    # --- disk tier ---
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key.replace(":", "-") + ".json")
+
+    def _disk_read(self, key: str) -> Tuple[Optional[str], int]:
+        """(result, bytes of the expired entry removed instead)."""
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                size = os.path.getsize(path)
+                os.remove(path)
+                return None, size
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)["result"], 0
+        except (OSError, ValueError, KeyError):
+            return None, 0
+
+    def _disk_write(self, key: str, result: str) -> Tuple[int, int]:
+        """Writes one entry; returns the change in (bytes, entries) on disk."""
+        path = self._path(key)
+        try:
+            old = os.path.getsize(path) if os.path.exists(path) else None
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"result": result}, f, ensure_ascii=False)
+            new = os.path.getsize(path)
+        except OSError as e:
+            log("media_cache_write_error", level="error", error=str(e))
+            return 0, 0
+        return new - (old or 0), 0 if old is not None else 1
+
+    def _disk_files(self) -> List[os.DirEntry]:
+        return [e for e in os.scandir(self.disk_dir) if e.name.endswith(".json")]
+
+    def _disk_evict(self) -> Tuple[int, int, int]:
+        """Removes the oldest entries down to 90% of the budget, so a full cache isn't
+        rescanned on every write; returns (bytes, entries, removed)."""
+        low_water = self.disk_max_bytes * 0.9
+        files = self._disk_files()
+        total = sum(e.stat().st_size for e in files)
+        entries = len(files)
+        for entry in sorted(files, key=lambda e: e.stat().st_mtime):
+            if total <= low_water:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            total -= size
+            entries -= 1
+        return total, entries, len(files) - entries
+
+    def stats(self) -> dict:
+        lookups = sum(self.counters[k] for k in ("memory_hits", "disk_hits", "phash_hits", "misses"))
+        hits = lookups - self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "memory": self.memory.stats(),
+            "disk_entries": self.disk_entries,
+            "disk_bytes": self.disk_bytes,
+            "phash_enabled": PIL_AVAILABLE,
+        }
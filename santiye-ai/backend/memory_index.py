@@ -0,0 +1,253 @@
+import asyncio
+import heapq
+import json
+import math
+import os
+import re
+import zlib
+from collections import Counter, OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from log_sink import log
+from metrics import LatencyWindow
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# Dotted/dotless i first (Python's lower() gets "I" and "İ" wrong for Turkish),
+# then fold the rest so "cimento" and "çimento" meet
+TR_LOWER = str.maketrans({"I": "ı", "İ": "i"})
+TR_FOLD = str.maketrans({"ç": "c", "ğ": "g", "ı": "i", "ö": "o", "ş": "s", "ü": "u", "â": "a", "î": "i", "û": "u"})
+STOPWORDS = {
+    "ve", "veya", "ile", "bir", "bu", "su", "o", "da", "de", "mi", "mu", "ne", "icin", "gibi",
+    "daha", "cok", "en", "ki", "ama", "ya", "var", "yok", "ben", "sen", "biz", "siz", "onlar",
+}
+TOKEN = re.compile(r"\w+")
+STEM = 5  # Turkish is agglutinative: the first 5 letters are a solid, cheap stem
+
+
+def normalize(text: str) -> str:
+    return text.translate(TR_LOWER).lower().translate(TR_FOLD)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t[:STEM] for t in TOKEN.findall(normalize(text)) if t not in STOPWORDS and len(t) > 1]
+
+
+def hashed_vector(text: str, dim: int):
+    """Feature-hashed character trigrams, L2-normalised (numpy only)."""
+    vec = np.zeros(dim, dtype=np.float32)
+    padded = f" {normalize(text)} "
+    for i in range(len(padded) - 2):
+        vec[zlib.crc32(padded[i:i + 3].encode("utf-8")) % dim] += 1.0
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+class CompanyIndex:
+    """BM25 over one company's site_memory rows, updated one row at a time."""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, dense_dim: int = 0):
+        self.k1 = k1
+        self.b = b
+        self.dense_dim = dense_dim if NUMPY_AVAILABLE else 0
+        self.docs: Dict[str, dict] = {}
+        self.lengths: Dict[str, int] = {}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.total_length = 0
+        self.vectors: Dict[str, object] = {}
+        self.matrix = None  # stacked vectors, rebuilt lazily after adds
+        self.matrix_ids: List[str] = []
+        self.latest = ""  # newest created_at seen, for catching up from the DB
+        self.dirty = False
+
+    def add(self, row: dict):
+        doc_id = row["id"]
+        if doc_id in self.docs:
+            return
+        self.docs[doc_id] = {k: row.get(k) for k in ("id", "content", "created_at", "category")}
+        terms = Counter(tokenize(row.get("content") or ""))
+        self.lengths[doc_id] = sum(terms.values())
+        self.total_length += self.lengths[doc_id]
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        if self.dense_dim:
+            self.vectors[doc_id] = hashed_vector(row.get("content") or "", self.dense_dim)
+            self.matrix = None
+        self.latest = max(self.latest, row.get("created_at") or "")
+        self.dirty = True
+
+    def search(self, query: str, k: int = 8, dense_weight: float = 0.3) -> List[dict]:
+        terms = set(tokenize(query))
+        if not self.docs or not terms:
+            return []
+        n = len(self.docs)
+        avg_len = self.total_length / n or 1.0
+        scores: Dict[str, float] = {}
+        for term in terms:
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_id] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        if self.dense_dim and scores:
+            self._blend_dense(query, scores, dense_weight)
+        if not scores:
+            return []
+        # Ties (same words) go to the newer report
+        best = heapq.nlargest(k, scores.items(), key=lambda kv: (kv[1], self.docs[kv[0]]["created_at"] or ""))
+        return [self.docs[doc_id] for doc_id, _ in best]
+
+    def _blend_dense(self, query: str, scores: Dict[str, float], weight: float):
+        """Adds trigram cosine similarity on top of BM25 (catches typos and suffix variants)."""
+        if self.matrix is None:
+            self.matrix_ids = list(self.vectors)
+            self.matrix = np.vstack([self.vectors[i] for i in self.matrix_ids])
+        sims = self.matrix @ hashed_vector(query, self.dense_dim)
+        top = max(scores.values())
+        for idx in np.argsort(-sims)[:50]:
+            doc_id = self.matrix_ids[idx]
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight * top * float(sims[idx])
+
+    def to_json(self) -> dict:
+        return {"docs": list(self.docs.values())}
+
+
+class MemoryIndex:
+    """Per-company CompanyIndex objects, loaded lazily and kept LRU in memory.
+
+    A company's index comes from `<disk_dir>/<company_id>.json` (just the rows;
+    postings are rebuilt on load) and is then caught up with rows newer than the
+    file via `load(company_id, since)`; with no file it is built from `load(company_id, None)`.
+    Dirty indexes are written back every `persist_interval` seconds and on close.
+    """
+
+    def __init__(self, load: Callable[[str, Optional[str]], Awaitable[List[dict]]],
+                 disk_dir: Optional[str] = None, maxsize: int = 200, dense_dim: int = 0,
+                 persist_interval: float = 60.0):
+        self.load = load
+        self.disk_dir = disk_dir
+        self.maxsize = maxsize
+        self.dense_dim = dense_dim
+        self.persist_interval = persist_interval
+        self.indexes: "OrderedDict[str, CompanyIndex]" = OrderedDict()
+        self.loading: Dict[str, asyncio.Task] = {}
+        self.task = None
+        self.search_latency = LatencyWindow()
+        self.counters = {"searches": 0, "loads_disk": 0, "loads_db": 0, "added": 0, "saved": 0, "evictions": 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    async def get(self, company_id: str) -> CompanyIndex:
+        idx = self.indexes.get(company_id)
+        if idx is not None:
+            self.indexes.move_to_end(company_id)
+            return idx
+        # One load per company even if several chats ask at once
+        task = self.loading.get(company_id)
+        if task is None:
+            task = asyncio.create_task(self._load(company_id))
+            self.loading[company_id] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.loading.pop(company_id, None)
+
+    async def _load(self, company_id: str) -> CompanyIndex:
+        idx = CompanyIndex(dense_dim=self.dense_dim)
+        rows = await asyncio.to_thread(self._read, company_id)
+        if rows is not None:
+            self.counters["loads_disk"] += 1
+            for row in rows:
+                idx.add(row)
+            idx.dirty = False
+        else:
+            self.counters["loads_db"] += 1
+        for row in await self.load(company_id, idx.latest or None):
+            idx.add(row)
+        self.indexes[company_id] = idx
+        while len(self.indexes) > self.maxsize:
+            old_id, old = self.indexes.popitem(last=False)
+            self.counters["evictions"] += 1
+            if old.dirty:
+                await asyncio.to_thread(self._write, old_id, old)
+        return idx
+
+    async def search(self, company_id: Optional[str], query: str, k: int = 8) -> List[dict]:
+        if not company_id or not query:
+            return []
+        idx = await self.get(company_id)
+        started = asyncio.get_running_loop().time()
+        hits = idx.search(query, k)
+        self.search_latency.observe(asyncio.get_running_loop().time() - started)
+        self.counters["searches"] += 1
+        return hits
+
+    def add(self, company_id: str, row: dict):
+        """Incremental update from save_site_memory. Unloaded companies pick it up on load."""
+        idx = self.indexes.get(company_id)
+        if idx is not None:
+            idx.add(row)
+            self.counters["added"] += 1
+
+    # --- persistence ---
+    def _path(self, company_id: str) -> str:
+        return os.path.join(self.disk_dir, f"{company_id}.json")
+
+    def _read(self, company_id: str) -> Optional[List[dict]]:
+        if not self.disk_dir or not os.path.exists(self._path(company_id)):
+            return None
+        try:
+            with open(self._path(company_id), "r", encoding="utf-8") as f:
+                return json.load(f)["docs"]
+        except (OSError, ValueError, KeyError) as e:
+            log("memory_index_read_error", level="warning", company_id=company_id, error=str(e))
+            return None
+
+    def _write(self, company_id: str, idx: CompanyIndex):
+        if not self.disk_dir:
+            return
+        tmp = self._path(company_id) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(idx.to_json(), f, ensure_ascii=False)
+        os.replace(tmp, self._path(company_id))
+        idx.dirty = False
+        self.counters["saved"] += 1
+
+    async def save_dirty(self):
+        for company_id, idx in list(self.indexes.items()):
+            if idx.dirty:
+                try:
+                    await asyncio.to_thread(self._write, company_id, idx)
+                except OSError as e:
+                    log("memory_index_write_error", level="error", company_id=company_id, error=str(e))
+
+    def start(self):
+        if self.task is None and self.disk_dir:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.persist_interval)
+            await self.save_dirty()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.save_dirty()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "companies": len(self.indexes),
+            "docs": sum(len(i.docs) for i in self.indexes.values()),
+            "dense": bool(self.dense_dim and NUMPY_AVAILABLE),
+            "search_latency": self.search_latency.summary(),
+        }
@@ -0,0 +1,68 @@
+import time
+from collections import deque
+
+
+class LatencyWindow:
+    """Rolling window of latency samples (seconds) with percentile summaries."""
+
+    def __init__(self, size: int = 500):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, pct: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[idx]
+
+    def summary(self) -> dict:
+        """Milliseconds, rounded, ready to be returned from a stats endpoint."""
+        avg = sum(self.samples) / len(self.samples) if self.samples else 0.0
+        return {
+            "count": self.count,
+            "avg_ms": round(avg * 1000, 1),
+            "p50_ms": round(self.percentile(50) * 1000, 1),
+            "p95_ms": round(self.percentile(95) * 1000, 1),
+            "max_ms": round(max(self.samples) * 1000, 1) if self.samples else 0.0,
+        }
+
+
+class Timer:
+    """`with Timer(window):` records the block duration into a LatencyWindow."""
+
+    def __init__(self, window: LatencyWindow):
+        self.window = window
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.window.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram:
+    """Per-bucket (non-cumulative) latency counts in seconds, e.g. {"le_0.5s": 12, ..., "inf": 1}."""
+
+    def __init__(self, bounds=(0.25, 0.5, 1, 2, 5, 10, 30)):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(self.bounds):
+            if seconds <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def summary(self) -> dict:
+        out = {f"le_{b}s": n for b, n in zip(self.bounds, self.counts)}
+        out["inf"] = self.counts[-1]
+        return out
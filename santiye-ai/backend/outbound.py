@@ -0,0 +1,147 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from graph_client import GraphClient, GRAPH_API_URL
+from log_sink import log
+from metrics import LatencyWindow
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens/second, up to `burst` saved up."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class PendingNotice:
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.started = False
+
+
+class OutboundSender:
+    """Rate-limited, retrying WhatsApp text sender.
+
+    - one token bucket per sending phone-number id (Graph API limits are per number)
+    - exponential backoff with jitter on 429 / 5xx / network errors
+    - progress notices ("🎧 dinleniyor...") are held for `coalesce_window` seconds and
+      dropped if the real answer is ready first, so fast answers arrive alone
+    """
+
+    def __init__(self, graph: GraphClient, rate: float = 20.0, burst: int = 40,
+                 max_retries: int = 4, base_delay: float = 0.5, coalesce_window: float = 2.0):
+        self.graph = graph
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.coalesce_window = coalesce_window
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.notices: Dict[str, PendingNotice] = {}
+        self.latency = LatencyWindow()
+        self.counters = {"sent": 0, "failed": 0, "retries": 0, "coalesced": 0}
+        self.recent_errors = deque(maxlen=20)
+
+    def bucket(self, phone_id: str) -> TokenBucket:
+        if phone_id not in self.buckets:
+            self.buckets[phone_id] = TokenBucket(self.rate, self.burst)
+        return self.buckets[phone_id]
+
+    async def send(self, phone_id: str, to_number: str, message: str) -> bool:
+        """Sends a text now. If a progress notice is still waiting, it is dropped."""
+        notice = self.notices.pop(to_number, None)
+        if notice and notice.task:
+            if not notice.started:
+                notice.task.cancel()
+                self.counters["coalesced"] += 1
+            else:
+                # Already on the wire: let it land first so the answer comes after it
+                await asyncio.gather(notice.task, return_exceptions=True)
+        return await self._deliver(phone_id, to_number, message)
+
+    def notify(self, phone_id: str, to_number: str, message: str):
+        """Schedules a progress notice that is only sent if no answer follows quickly."""
+        notice = PendingNotice()
+        notice.task = asyncio.create_task(self._delayed_notice(notice, phone_id, to_number, message))
+        self.notices[to_number] = notice
+
+    async def _delayed_notice(self, notice: PendingNotice, phone_id: str, to_number: str, message: str):
+        await asyncio.sleep(self.coalesce_window)
+        notice.started = True
+        try:
+            await self._deliver(phone_id, to_number, message)
+        finally:
+            if self.notices.get(to_number) is notice:
+                del self.notices[to_number]
+
+    async def _deliver(self, phone_id: str, to_number: str, message: str) -> bool:
+        url = f"{GRAPH_API_URL}/{phone_id}/messages"
+        data = {
+            "messaging_product": "whatsapp",
+            "to": to_number,
+            "type": "text",
+            "text": {"body": message}
+        }
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            await self.bucket(phone_id).acquire()
+            retry_after = None
+            try:
+                response = await self.graph.request("POST", url, json=data)
+                if response.status_code == 200:
+                    self.counters["sent"] += 1
+                    self.latency.observe(time.perf_counter() - started)
+                    return True
+                error = f"{response.status_code}: {response.text[:300]}"
+                retryable = response.status_code == 429 or response.status_code >= 500
+                retry_after = response.headers.get("retry-after")
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                retryable = True
+
+            if not retryable or attempt == self.max_retries:
+                break
+            self.counters["retries"] += 1
+            delay = self.base_delay * (2 ** attempt) * (0.5 + random.random())
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            await asyncio.sleep(delay)
+
+        self.counters["failed"] += 1
+        # Served by the public /stats endpoint: keep only the last digits of the recipient
+        self.recent_errors.append({"to": "***" + to_number[-4:], "error": error, "at": time.time()})
+        log("send_failed", level="error", to=to_number, error=error)
+        return False
+
+    async def close(self):
+        tasks = [n.task for n in self.notices.values() if n.task]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.notices.clear()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "pending_notices": len(self.notices),
+            "delivery_latency": self.latency.summary(),
+            "recent_errors": list(self.recent_errors),
+        }
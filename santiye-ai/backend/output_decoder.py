@@ -0,0 +1,288 @@
+# Shared by santiye-ai and ask-analiz-web (separate deployments): the two copies
+# of this file are kept identical.
+import json
+import re
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+try:
+    from log_sink import log
+except ImportError:  # ask-analiz-web has no log sink; it logs with print
+    def log(event: str, level: str = "info", **fields):
+        print(f"[{level.upper()}] - {event} " + " ".join(f"{k}={v}" for k, v in fields.items()))
+
+FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.S)
+CLOSERS = {"{": "}", "[": "]"}
+MISSING = object()
+
+
+class OutputError(ValueError):
+    """The model's output could not be turned into a valid object."""
+
+
+def strip_fences(text: str) -> str:
+    """The JSON inside ```json fences or surrounding prose, from the first { on."""
+    text = (text or "").strip()
+    fenced = FENCE.search(text)
+    if fenced:
+        text = fenced.group(1).strip()
+    start = text.find("{")
+    if start > 0:
+        text = text[start:]
+    end = text.rfind("}")
+    if end != -1 and not _open_brackets(text):
+        text = text[:end + 1]  # drop trailing prose after a complete object
+    return text
+
+
+def _open_brackets(text: str) -> bool:
+    depth, in_string, escape = 0, False, False
+    for ch in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            depth += 1
+        elif ch in "}]":
+            depth -= 1
+    return depth > 0 or in_string
+
+
+def repair(text: str) -> str:
+    """Best-effort completion of truncated or slightly broken JSON.
+
+    Drops trailing commas, closes an unterminated string and any open brackets.
+    If the tail is still unparseable (cut inside a key, after a colon, inside
+    `tru`), falls back to the last point where a complete value ended.
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    safe: List[Tuple[int, List[str]]] = []  # (len(out), stack) where a value may end
+    in_string = False
+    escape_at, escape_left = 0, 0  # escape_left: -1 right after "\\", else \u hex digits still due
+    for ch in text:
+        if in_string:
+            if escape_left == -1:
+                escape_left = 4 if ch == "u" else 0
+            elif escape_left:
+                escape_left -= 1
+            elif ch == "\\":
+                escape_at, escape_left = len(out), -1
+            elif ch == '"':
+                in_string = False
+            out.append(ch)
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append(CLOSERS[ch])
+            out.append(ch)
+            safe.append((len(out), list(stack)))
+            continue
+        elif ch in "}]":
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if stack:
+                stack.pop()
+            out.append(ch)
+            safe.append((len(out), list(stack)))
+            continue
+        elif ch == ",":
+            safe.append((len(out), list(stack)))
+        out.append(ch)
+
+    if in_string:
+        if escape_left:
+            del out[escape_at:]
+        out.append('"')
+    tail = "".join(out).rstrip().rstrip(",")
+    candidates = [tail + "".join(reversed(stack))]
+    for length, saved in reversed(safe[-20:]):
+        candidates.append("".join(out[:length]).rstrip().rstrip(",") + "".join(reversed(saved)))
+    for candidate in candidates:
+        try:
+            json.loads(candidate)
+            return candidate
+        except ValueError:
+            continue
+    return candidates[0]
+
+
+def loads_lenient(text: str) -> Tuple[Any, str]:
+    """(object, how): how is "fast", "fenced" or "repaired". Raises OutputError."""
+    try:
+        return json.loads(text), "fast"
+    except (TypeError, ValueError):
+        pass
+    stripped = strip_fences(text)
+    try:
+        return json.loads(stripped), "fenced"
+    except ValueError:
+        pass
+    try:
+        return json.loads(repair(stripped)), "repaired"
+    except ValueError as e:
+        raise OutputError(f"unparseable model output: {e}") from e
+
+
+class Field:
+    """One schema field: accepted type, whether it is required, and its default."""
+
+    def __init__(self, kind: type, required: bool = True, default: Any = MISSING, nullable: bool = False,
+                 minimum: Optional[float] = None, maximum: Optional[float] = None):
+        self.kind = kind
+        self.required = required
+        self.default = default
+        self.nullable = nullable
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def coerce(self, value: Any) -> Any:
+        """The cleaned value, or MISSING if it can't be used."""
+        if value is None or (isinstance(value, str) and value.strip().lower() in ("", "null", "none")):
+            return None if self.nullable else MISSING
+        if self.kind is str:
+            return value.strip() if isinstance(value, str) else MISSING
+        if self.kind is int:
+            if isinstance(value, bool):
+                return MISSING
+            if isinstance(value, str):
+                match = re.search(r"-?\d+(?:\.\d+)?", value)  # "75", "%75", "75/100"
+                if not match:
+                    return MISSING
+                value = float(match.group())
+            if not isinstance(value, (int, float)):
+                return MISSING
+            value = int(round(value))
+            if self.minimum is not None:
+                value = max(value, int(self.minimum))
+            if self.maximum is not None:
+                value = min(value, int(self.maximum))
+            return value
+        return value if isinstance(value, self.kind) else MISSING
+
+
+class Schema:
+    """Compiled field checks for a top-level object; unknown keys pass through."""
+
+    def __init__(self, **fields: Field):
+        self.fields = list(fields.items())
+
+    def validate(self, data: Any) -> Tuple[dict, List[str]]:
+        """(cleaned object, required fields that are missing or invalid)."""
+        if not isinstance(data, dict):  # e.g. a JSON list: nothing usable, defaults only
+            data = {}
+        clean = dict(data)
+        missing = []
+        for name, f in self.fields:
+            value = f.coerce(data[name]) if name in data else MISSING
+            if value is MISSING:
+                clean.pop(name, None)
+                if f.required:
+                    missing.append(name)
+                elif f.default is not MISSING:
+                    clean[name] = f.default
+            else:
+                clean[name] = value
+        return clean, missing
+
+    def fill_defaults(self, clean: dict, missing: List[str]) -> List[str]:
+        """Fills missing fields that have a default; returns those that still lack a value."""
+        left = []
+        for name, f in self.fields:
+            if name not in missing:
+                continue
+            if f.default is MISSING:
+                left.append(name)
+            else:
+                clean[name] = f.default
+        return left
+
+
+CHAT_SCHEMA = Schema(
+    insight=Field(str),
+    risk_score=Field(int, required=False, default=0, minimum=0, maximum=100),
+    memory_update=Field(str, required=False, default=None, nullable=True),
+)
+
+# ask(missing_fields, broken_output) -> model text holding just those fields
+Ask = Callable[[List[str], str], Awaitable[str]]
+
+
+class OutputDecoder:
+    """Turns a model's JSON answer into a schema-valid object with as few round trips as possible.
+
+    Fast path is the object already parsed from a stream (`parsed`), else plain
+    json.loads; then fence stripping; then repair of truncated
+    JSON. Only when required fields are still missing is the model asked again, and
+    then only for those fields (`ask`); fields with a default are filled as a last resort.
+    """
+
+    def __init__(self, schema: Schema, max_retries: int = 1):
+        self.schema = schema
+        self.max_retries = max_retries
+        self.counters = {"decoded": 0, "streamed": 0, "fast": 0, "fenced": 0, "repaired": 0, "unparseable": 0,
+                         "retries": 0, "retry_recovered": 0, "defaulted": 0, "failed": 0}
+
+    def decode(self, text: str, parsed: Optional[dict] = None) -> Tuple[dict, List[str]]:
+        """(cleaned object, missing required fields); no model calls."""
+        self.counters["decoded"] += 1
+        if parsed is not None:
+            self.counters["streamed"] += 1
+            return self.schema.validate(parsed)
+        try:
+            data, how = loads_lenient(text)
+        except OutputError:
+            self.counters["unparseable"] += 1
+            return {}, [name for name, f in self.schema.fields if f.required]
+        self.counters[how] += 1
+        return self.schema.validate(data)
+
+    async def complete(self, text: str, ask: Optional[Ask] = None, parsed: Optional[dict] = None) -> dict:
+        """Decodes `text`, re-asking for missing fields; raises OutputError if it can't."""
+        result, missing = self.decode(text, parsed)
+        if missing and result:
+            log("llm_output_incomplete", level="warning", missing=missing, chars=len(text or ""))
+        for _ in range(self.max_retries if ask else 0):
+            if not missing:
+                break
+            self.counters["retries"] += 1
+            try:
+                data, _ = loads_lenient(await ask(missing, text))
+            except Exception as e:
+                log("llm_output_retry_error", level="warning", missing=missing, error=str(e))
+                break
+            extra, _ = self.schema.validate(data)
+            result.update({k: v for k, v in extra.items() if k in missing})
+            missing = [name for name in missing if name not in result]
+            if not missing:
+                self.counters["retry_recovered"] += 1
+        if missing:
+            left = self.schema.fill_defaults(result, missing)
+            if left:
+                self.counters["failed"] += 1
+                raise OutputError(f"model output missing {', '.join(left)}")
+            self.counters["defaulted"] += 1
+        return result
+
+    def stats(self) -> dict:
+        n = self.counters["decoded"] or 1
+        return {
+            **self.counters,
+            "repair_rate": round((self.counters["fenced"] + self.counters["repaired"]) / n, 3),
+            "retry_rate": round(self.counters["retries"] / n, 3),
+            # Answers that used to end in a canned error / a full regeneration
+            "avoided_regenerations": self.counters["fenced"] + self.counters["repaired"] + self.counters["defaulted"],
+        }
+
+
+def missing_fields_prompt(missing: List[str]) -> str:
+    return ("Önceki cevabın eksik veya bozuk geldi. Cevabı tekrar yazma; sadece şu alanları "
+            f"geçerli JSON olarak ver: {', '.join(missing)}")
@@ -0,0 +1,254 @@
+-- MONTHLY PARTITIONS + RETENTION FOR CHAT LOGS
+-- group_chat_logs keeps the full Meta raw_payload for every group message and
+-- dm_logs grows with every DM turn. Both become RANGE partitions by created_at
+-- (one table per month), so:
+--   * recent-window queries only touch the newest partitions' indexes,
+--   * old months can be archived (retention.py -> gzip NDJSON) and dropped
+--     in one statement instead of a giant DELETE.
+-- Run once, in a quiet moment (it copies the existing rows).
+--
+-- NOTE: a partitioned table's primary key must contain the partition key, so the
+-- key becomes (id, created_at). The backend's write-behind buffer upserts these
+-- two tables on (id, created_at); deploy the backend together with this file.
+
+BEGIN;
+
+-- 1. Partition helpers ------------------------------------------------------
+CREATE OR REPLACE FUNCTION create_chat_log_partition(p_parent TEXT, p_month DATE)
+RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_start DATE := date_trunc('month', p_month)::date;
+    v_name TEXT := p_parent || '_p' || to_char(v_start, 'YYYYMM');
+BEGIN
+    IF p_parent NOT IN ('group_chat_logs', 'dm_logs') THEN
+        RAISE EXCEPTION 'not a chat log table: %', p_parent;
+    END IF;
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+        v_name, p_parent, v_start, (v_start + INTERVAL '1 month')::date
+    );
+    RETURN v_name;
+END;
+$$;
+
+-- Called by retention.py on every run; keeps a few months created ahead
+CREATE OR REPLACE FUNCTION ensure_chat_log_partitions(p_months_ahead INT DEFAULT 2)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    i INT;
+BEGIN
+    FOR i IN 0..p_months_ahead LOOP
+        PERFORM create_chat_log_partition('group_chat_logs', (now() + make_interval(months => i))::date);
+        PERFORM create_chat_log_partition('dm_logs', (now() + make_interval(months => i))::date);
+    END LOOP;
+END;
+$$;
+
+-- 2. group_chat_logs --------------------------------------------------------
+ALTER TABLE group_chat_logs RENAME TO group_chat_logs_legacy;
+
+CREATE TABLE group_chat_logs (
+    id UUID DEFAULT uuid_generate_v4(),
+    group_id TEXT NOT NULL,
+    company_id UUID REFERENCES companies(id),
+    sender_phone TEXT NOT NULL,
+    sender_name TEXT,
+    message_type TEXT DEFAULT 'text',
+    content TEXT,
+    media_url TEXT,
+    raw_payload JSONB,
+    payload_compacted BOOLEAN NOT NULL DEFAULT FALSE, -- raw_payload stripped by compact_chat_logs()
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Safety net: rows for a month nobody created a partition for land here
+CREATE TABLE group_chat_logs_default PARTITION OF group_chat_logs DEFAULT;
+
+-- Indexes are declared once on the parent and created on every partition
+CREATE INDEX idx_group_logs_group_recent ON group_chat_logs(group_id, created_at DESC);
+CREATE INDEX idx_group_logs_company_recent ON group_chat_logs(company_id, created_at DESC);
+CREATE INDEX idx_group_logs_uncompacted ON group_chat_logs(created_at) WHERE NOT payload_compacted;
+
+-- 3. dm_logs ----------------------------------------------------------------
+ALTER TABLE dm_logs RENAME TO dm_logs_legacy;
+
+CREATE TABLE dm_logs (
+    id UUID DEFAULT uuid_generate_v4(),
+    phone_number TEXT NOT NULL,
+    company_id UUID REFERENCES companies(id),
+    role TEXT NOT NULL DEFAULT 'user',
+    content TEXT,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE dm_logs_default PARTITION OF dm_logs DEFAULT;
+
+CREATE INDEX idx_dm_logs_phone_recent ON dm_logs(phone_number, created_at DESC);
+CREATE INDEX idx_dm_logs_company_recent ON dm_logs(company_id, created_at DESC);
+
+-- 4. Partitions for the existing months, then copy the rows -----------------
+DO $$
+DECLARE
+    m DATE;
+BEGIN
+    FOR m IN
+        SELECT generate_series(
+            date_trunc('month', COALESCE(LEAST(
+                (SELECT MIN(created_at) FROM group_chat_logs_legacy),
+                (SELECT MIN(created_at) FROM dm_logs_legacy)
+            ), now())),
+            date_trunc('month', now()),
+            INTERVAL '1 month'
+        )::date
+    LOOP
+        PERFORM create_chat_log_partition('group_chat_logs', m);
+        PERFORM create_chat_log_partition('dm_logs', m);
+    END LOOP;
+END;
+$$;
+
+SELECT ensure_chat_log_partitions(2);
+
+INSERT INTO group_chat_logs (id, group_id, company_id, sender_phone, sender_name, message_type,
+                             content, media_url, raw_payload, created_at)
+SELECT id, group_id, company_id, sender_phone, sender_name, message_type,
+       content, media_url, raw_payload, COALESCE(created_at, now())
+FROM group_chat_logs_legacy;
+
+INSERT INTO dm_logs (id, phone_number, company_id, role, content, created_at)
+SELECT id, phone_number, company_id, role, content, COALESCE(created_at, now())
+FROM dm_logs_legacy;
+
+DROP TABLE group_chat_logs_legacy;
+DROP TABLE dm_logs_legacy;
+
+-- 5. Per-company retention --------------------------------------------------
+-- compact_after_days: raw_payload is reduced to ids/type after this many days
+-- keep_days: rows are deleted after this many days (NULL = until the month's
+--            partition is archived by retention.py)
+CREATE TABLE IF NOT EXISTS company_log_retention (
+    company_id UUID PRIMARY KEY REFERENCES companies(id) ON DELETE CASCADE,
+    compact_after_days INT NOT NULL DEFAULT 30,
+    keep_days INT,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- 6. Maintenance RPCs (retention.py) -----------------------------------------
+-- Strips the payload fields that duplicate columns (text body, sender, contacts)
+-- and keeps what identifies the message and its media. Works in batches; returns
+-- the number of rows touched so the caller can loop until 0.
+CREATE OR REPLACE FUNCTION compact_chat_logs(p_default_days INT DEFAULT 30, p_batch INT DEFAULT 5000)
+RETURNS INT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_count INT;
+BEGIN
+    WITH victims AS (
+        SELECT g.id, g.created_at
+        FROM group_chat_logs g
+        LEFT JOIN company_log_retention r ON r.company_id = g.company_id
+        WHERE NOT g.payload_compacted
+          AND g.created_at < now() - make_interval(days => COALESCE(r.compact_after_days, p_default_days))
+        LIMIT p_batch
+    )
+    UPDATE group_chat_logs g
+    SET raw_payload = CASE WHEN g.raw_payload IS NULL THEN NULL ELSE jsonb_strip_nulls(jsonb_build_object(
+            'id', g.raw_payload->'id',
+            'type', g.raw_payload->'type',
+            'timestamp', g.raw_payload->'timestamp',
+            'media_id', g.raw_payload->(g.raw_payload->>'type')->'id',
+            'mime_type', g.raw_payload->(g.raw_payload->>'type')->'mime_type'
+        )) END,
+        payload_compacted = TRUE
+    FROM victims v
+    WHERE g.id = v.id AND g.created_at = v.created_at;
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    RETURN v_count;
+END;
+$$;
+
+-- Deletes rows past their company's keep_days, in batches
+CREATE OR REPLACE FUNCTION purge_chat_logs(p_batch INT DEFAULT 5000)
+RETURNS INT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_groups INT;
+    v_dms INT;
+BEGIN
+    WITH victims AS (
+        SELECT g.id, g.created_at
+        FROM group_chat_logs g
+        JOIN company_log_retention r ON r.company_id = g.company_id
+        WHERE r.keep_days IS NOT NULL
+          AND g.created_at < now() - make_interval(days => r.keep_days)
+        LIMIT p_batch
+    )
+    DELETE FROM group_chat_logs g USING victims v
+    WHERE g.id = v.id AND g.created_at = v.created_at;
+    GET DIAGNOSTICS v_groups = ROW_COUNT;
+
+    WITH victims AS (
+        SELECT d.id, d.created_at
+        FROM dm_logs d
+        JOIN company_log_retention r ON r.company_id = d.company_id
+        WHERE r.keep_days IS NOT NULL
+          AND d.created_at < now() - make_interval(days => r.keep_days)
+        LIMIT p_batch
+    )
+    DELETE FROM dm_logs d USING victims v
+    WHERE d.id = v.id AND d.created_at = v.created_at;
+    GET DIAGNOSTICS v_dms = ROW_COUNT;
+
+    RETURN v_groups + v_dms;
+END;
+$$;
+
+-- Monthly partitions that ended before p_before (candidates for archiving)
+CREATE OR REPLACE FUNCTION archivable_chat_log_partitions(p_before DATE)
+RETURNS TABLE(parent TEXT, month DATE)
+LANGUAGE SQL
+STABLE
+AS $$
+    SELECT parent.relname::text, to_date(substring(child.relname from '_p(\d{6})$'), 'YYYYMM')
+    FROM pg_inherits i
+    JOIN pg_class child ON child.oid = i.inhrelid
+    JOIN pg_class parent ON parent.oid = i.inhparent
+    WHERE parent.relname IN ('group_chat_logs', 'dm_logs')
+      AND child.relname ~ '_p\d{6}$'
+      AND (to_date(substring(child.relname from '_p(\d{6})$'), 'YYYYMM') + INTERVAL '1 month') <= p_before
+    ORDER BY 2, 1;
+$$;
+
+-- Detaches and drops one month. Only called after retention.py wrote the archive.
+CREATE OR REPLACE FUNCTION drop_chat_log_partition(p_parent TEXT, p_month DATE)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_name TEXT := p_parent || '_p' || to_char(date_trunc('month', p_month), 'YYYYMM');
+BEGIN
+    IF p_parent NOT IN ('group_chat_logs', 'dm_logs') THEN
+        RAISE EXCEPTION 'not a chat log table: %', p_parent;
+    END IF;
+    EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', p_parent, v_name);
+    EXECUTE format('DROP TABLE %I', v_name);
+END;
+$$;
+
+-- Maintenance is for the service key only
+REVOKE EXECUTE ON FUNCTION create_chat_log_partition(TEXT, DATE) FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION ensure_chat_log_partitions(INT) FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION compact_chat_logs(INT, INT) FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION purge_chat_logs(INT) FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION archivable_chat_log_partitions(DATE) FROM PUBLIC, anon, authenticated;
+REVOKE EXECUTE ON FUNCTION drop_chat_log_partition(TEXT, DATE) FROM PUBLIC, anon, authenticated;
+
+COMMIT;
@@ -0,0 +1,151 @@
+import hashlib
+import re
+from typing import Dict, List, Optional, Tuple
+
+from metrics import LatencyWindow
+from ttl_cache import TTLCache
+
+SLOTS = ("HARD_FACTS", "MEMORY_CONTEXT", "CURRENT_TIME")
+PLACEHOLDER = re.compile(r"\{(" + "|".join(SLOTS) + r")\}")
+
+# Static persona + rules first, volatile data last: DeepSeek/OpenAI cache the
+# longest identical prompt prefix, so everything above HARD FACTS is served from
+# the provider's prefix cache on every call, whatever the company or the minute.
+DAYI_PROMPT = """### ROLE & PERSONA
+You are the SITE CHIEF (Şantiye Şefi). Your name is "Dayı".
+You speak Turkish. You are experienced, fatherly, strictly professional but warm.
+You manage a construction site.
+
+### INSTRUCTIONS
+1. Analyze the user's input.
+2. If the user is REPORTING a new fact (e.g., "Cement finished"), EXTRACT it to 'memory_update'.
+3. If the user is ASKING a question, use the HARD FACTS first, then HIVEMIND.
+4. Give valid, safe, and direct advice.
+5. **VERY IMPORTANT:** BE CONCISE. Do not write long paragraphs. Keep it under 2 sentences if possible. Talk like a busy foreman.
+6. Pay close attention to timestamps. If a memory is from yesterday, say "yesterday".
+
+### OUTPUT FORMAT (JSON)
+{
+  "insight": "Your direct answer to the user.",
+  "risk_score": 0-100,
+  "memory_update": "Extracted new fact or null"
+}
+
+### HARD FACTS (KESİN BİLGİ - DEĞİŞMEZ)
+These are the REAL numbers from the database. Trust these over any memory.
+{HARD_FACTS}
+
+### HIVEMIND (SITE MEMORY - CHAT HISTORY)
+Recent conversations:
+{MEMORY_CONTEXT}
+
+### CURRENT TIME
+Now is: {CURRENT_TIME} (YYYY-MM-DD HH:MM)
+"""
+
+
+class PromptTemplate:
+    """A prompt parsed once into literal text and {PLACEHOLDER} slots.
+
+    Rendering is one join; only the known SLOTS are placeholders, so the JSON
+    braces in the output-format section and any other {TEXT} stay literal.
+    """
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.segments: List[Tuple[str, Optional[str]]] = []
+        pos = 0
+        for m in PLACEHOLDER.finditer(text):
+            self.segments.append((text[pos:m.start()], m.group(1)))
+            pos = m.end()
+        self.segments.append((text[pos:], None))
+        self.slots = [slot for _, slot in self.segments if slot]
+        # Everything before the first slot is identical on every call
+        self.static_prefix = self.segments[0][0]
+
+    def render(self, **values: str) -> str:
+        return "".join(text + (values.get(slot, "") if slot else "") for text, slot in self.segments)
+
+
+class PromptUsage:
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.hit_tokens = 0
+        self.miss_tokens = 0
+        self.hit_latency = LatencyWindow(200)
+        self.miss_latency = LatencyWindow(200)
+
+    def summary(self) -> dict:
+        cached = self.hit_tokens + self.miss_tokens
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "cache_hit_tokens": self.hit_tokens,
+            "cache_miss_tokens": self.miss_tokens,
+            "cache_hit_ratio": round(self.hit_tokens / cached, 3) if cached else 0.0,
+            "latency_cache_hit": self.hit_latency.summary(),
+            "latency_cache_miss": self.miss_latency.summary(),
+        }
+
+
+def cache_tokens(usage) -> Tuple[int, int]:
+    """(hit, miss) prompt tokens from a completion's usage block.
+
+    DeepSeek reports prompt_cache_hit_tokens / prompt_cache_miss_tokens; OpenAI
+    reports prompt_tokens_details.cached_tokens.
+    """
+    hit = getattr(usage, "prompt_cache_hit_tokens", None)
+    miss = getattr(usage, "prompt_cache_miss_tokens", None)
+    if hit is None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        hit = getattr(details, "cached_tokens", None) or 0
+        miss = (getattr(usage, "prompt_tokens", 0) or 0) - hit
+    return int(hit or 0), int(miss or 0)
+
+
+class PromptRegistry:
+    """Compiled system prompts: the default Dayı prompt, per-company prompts by id,
+    and ad-hoc `system_prompt` texts (compiled once per distinct text)."""
+
+    def __init__(self, default: PromptTemplate, adhoc_size: int = 200):
+        self.default = default
+        self.company: Dict[Tuple[str, str], PromptTemplate] = {}
+        self.adhoc = TTLCache(maxsize=adhoc_size, ttl=24 * 3600)
+        self.usage: Dict[str, PromptUsage] = {}
+
+    def register(self, company_id: str, prompt_id: str, text: str) -> PromptTemplate:
+        template = PromptTemplate(f"{company_id}:{prompt_id}", text)
+        self.company[(company_id, prompt_id)] = template
+        return template
+
+    def resolve(self, company_id: Optional[str] = None, prompt_id: Optional[str] = None,
+                text: Optional[str] = None) -> PromptTemplate:
+        if text:
+            key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+            template = self.adhoc.get(key)
+            if template is None:
+                template = PromptTemplate(f"adhoc:{key[:8]}", text)
+                self.adhoc.set(key, template)
+            return template
+        if company_id and prompt_id and (company_id, prompt_id) in self.company:
+            return self.company[(company_id, prompt_id)]
+        return self.default
+
+    def record(self, template: PromptTemplate, usage, seconds: float):
+        stats = self.usage.setdefault(template.name, PromptUsage())
+        stats.calls += 1
+        if usage is None:
+            return
+        hit, miss = cache_tokens(usage)
+        stats.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+        stats.hit_tokens += hit
+        stats.miss_tokens += miss
+        (stats.hit_latency if hit else stats.miss_latency).observe(seconds)
+
+    def stats(self) -> dict:
+        return {
+            "company_prompts": len(self.company),
+            "adhoc_prompts": len(self.adhoc.data),
+            "usage": {name: u.summary() for name, u in sorted(self.usage.items())},
+        }
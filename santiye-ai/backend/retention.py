@@ -0,0 +1,134 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+from datetime import date, datetime, timezone
+
+from keyset import keyset_pages
+from log_sink import log
+from metrics import LatencyWindow
+
+
+def month_add(d: date, months: int) -> date:
+    n = d.year * 12 + d.month - 1 + months
+    return date(n // 12, n % 12 + 1, 1)
+
+
+class RetentionJob:
+    """Background maintenance for the month-partitioned chat logs (partition_chat_logs.sql).
+
+    Every `interval` seconds it:
+      1. creates the next months' partitions,
+      2. compacts raw_payload older than each company's compact_after_days,
+      3. deletes rows past each company's keep_days,
+      4. if `archive_months` > 0, writes every month older than that to
+         `archive_dir/<table>/<YYYY-MM>.ndjson.gz` and drops its partition.
+    """
+
+    def __init__(self, db, interval: float = 6 * 3600, compact_days: int = 30, archive_months: int = 0,
+                 archive_dir: str = "archive", batch: int = 5000, page_size: int = 1000):
+        self.db = db
+        self.interval = interval
+        self.compact_days = compact_days
+        self.archive_months = archive_months
+        self.archive_dir = archive_dir
+        self.batch = batch
+        self.page_size = page_size
+        self.task = None
+        self.run_latency = LatencyWindow(50)
+        self.last_run = None
+        self.last_error = None
+        self.counters = {"runs": 0, "errors": 0, "compacted": 0, "purged": 0,
+                         "archived_partitions": 0, "archived_rows": 0}
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await self.run_once()
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        started = time.perf_counter()
+        try:
+            await self.rpc("ensure_chat_log_partitions", {"p_months_ahead": 2})
+            self.counters["compacted"] += await self.drain("compact_chat_logs", {
+                "p_default_days": self.compact_days, "p_batch": self.batch,
+            })
+            self.counters["purged"] += await self.drain("purge_chat_logs", {"p_batch": self.batch})
+            if self.archive_months > 0:
+                await self.archive_old_partitions()
+            self.counters["runs"] += 1
+        except Exception as e:
+            self.counters["errors"] += 1
+            self.last_error = str(e)
+            log("retention_error", level="error", error=str(e))
+        finally:
+            self.run_latency.observe(time.perf_counter() - started)
+            self.last_run = datetime.now(timezone.utc).isoformat()
+        log("retention_run", compacted=self.counters["compacted"], purged=self.counters["purged"],
+            archived=self.counters["archived_partitions"])
+
+    async def rpc(self, fn: str, params: dict):
+        # Batches can be slow on big months; don't hold the chat's default deadline
+        return await self.db.execute(f"rpc.{fn}", self.db.client.rpc(fn, params), timeout=120)
+
+    async def drain(self, fn: str, params: dict) -> int:
+        """Calls a batched RPC until it touches fewer rows than one batch."""
+        total = 0
+        while True:
+            res = await self.rpc(fn, params)
+            n = int(res.data or 0)
+            total += n
+            if n < self.batch:
+                return total
+
+    # --- archive ---
+    async def archive_old_partitions(self):
+        before = month_add(datetime.now(timezone.utc).date().replace(day=1), -self.archive_months)
+        res = await self.rpc("archivable_chat_log_partitions", {"p_before": before.isoformat()})
+        for item in res.data or []:
+            month = date.fromisoformat(item["month"][:10])
+            rows = await self.archive_month(item["parent"], month)
+            # Only drop once the file is complete and renamed into place
+            await self.rpc("drop_chat_log_partition", {"p_parent": item["parent"], "p_month": month.isoformat()})
+            self.counters["archived_partitions"] += 1
+            self.counters["archived_rows"] += rows
+            log("partition_archived", table=item["parent"], month=month.isoformat()[:7], rows=rows)
+
+    async def archive_month(self, table: str, month: date) -> int:
+        folder = os.path.join(self.archive_dir, table)
+        path = os.path.join(folder, f"{month.isoformat()[:7]}.ndjson.gz")
+        tmp = path + ".tmp"
+        os.makedirs(folder, exist_ok=True)
+        f = await asyncio.to_thread(gzip.open, tmp, "wt", encoding="utf-8")
+        rows = 0
+        try:
+            async for page in keyset_pages(self.db, table, "*", since=month.isoformat(),
+                                           until=month_add(month, 1).isoformat(), page_size=self.page_size):
+                chunk = "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in page)
+                await asyncio.to_thread(f.write, chunk)
+                rows += len(page)
+        finally:
+            await asyncio.to_thread(f.close)
+        os.replace(tmp, path)
+        return rows
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "last_run": self.last_run,
+            "last_error": self.last_error,
+            "compact_days": self.compact_days,
+            "archive_months": self.archive_months,
+            "run_latency": self.run_latency.summary(),
+        }
@@ -0,0 +1,69 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after a TTL (seconds).
+
+    Plain dict + OrderedDict, no locking: it is only touched from the event loop.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        """Returns (found, value), so a cached None can be told apart from a miss."""
+        item = self.data.get(key)
+        if item is None:
+            self.misses += 1
+            return False, None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self.data[key]
+            self.misses += 1
+            return False, None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        found, value = self.lookup(key)
+        return value if found else default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        self.data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def contains(self, key: Hashable) -> bool:
+        """Membership test that does not touch hit/miss counters or LRU order."""
+        item = self.data.get(key)
+        return item is not None and item[0] >= time.monotonic()
+
+    def pop(self, key: Hashable):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "evictions": self.evictions,
+        }
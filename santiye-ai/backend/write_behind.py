@@ -0,0 +1,237 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from log_sink import log
+from metrics import LatencyWindow
+
+
+class WriteBehindBuffer:
+    """Groups single-row inserts per table and flushes them as bulk inserts.
+
+    Flushes every `interval` seconds or as soon as a table has `max_rows` rows.
+    Rows get their `id` and `created_at` here, so ordering survives batching and
+    readers can merge `pending()` rows with DB results without duplicates.
+    Rows that fail go to a local JSON-lines spool and are retried later; a spooled
+    row leaves the file only once it has been written (at-least-once), and
+    `close()` flushes until nothing is buffered.
+    """
+
+    def __init__(self, db, interval: float = 0.5, max_rows: int = 100,
+                 spool_path: str = "write_behind_spool.jsonl", max_attempts: int = 10,
+                 spool_retry: float = 30.0, conflict_columns: Optional[Dict[str, str]] = None):
+        self.db = db
+        self.interval = interval
+        self.max_rows = max_rows
+        self.spool_path = spool_path
+        self.max_attempts = max_attempts
+        self.spool_retry = spool_retry
+        # Upsert target per table; partitioned tables are keyed on (id, created_at)
+        self.conflict_columns = conflict_columns or {}
+        self.failures = 0  # consecutive failed batches, drives the replay backoff
+        self.next_replay = 0.0
+        self.rows: Dict[str, List[dict]] = {}
+        self.inflight: Dict[str, List[dict]] = {}
+        self.spooled: List[dict] = []  # mirror of the spool file: {"table", "row", "attempts"}
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.flush_latency = LatencyWindow()
+        self.counters = {"buffered": 0, "flushed": 0, "batches": 0, "row_retries": 0,
+                         "spooled": 0, "replayed": 0, "dropped": 0}
+
+    def add(self, table: str, row: dict) -> dict:
+        row = {"id": str(uuid.uuid4()), "created_at": datetime.now(timezone.utc).isoformat(), **row}
+        self.rows.setdefault(table, []).append(row)
+        self.counters["buffered"] += 1
+        if len(self.rows[table]) >= self.max_rows:
+            self.wakeup.set()
+        return row
+
+    def pending(self, table: str, **match) -> List[dict]:
+        """Rows not yet confirmed in the DB (spooled, in flight or buffered) matching all `match` fields."""
+        rows = [i["row"] for i in self.spooled if i["table"] == table]
+        rows += self.inflight.get(table, []) + self.rows.get(table, [])
+        return [r for r in rows if all(r.get(k) == v for k, v in match.items())]
+
+    # --- lifecycle ---
+    def start(self):
+        if self.task is None:
+            self._load_spool()
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        # One last replay attempt, then flush until nothing is buffered (rows may
+        # still be added while a flush awaits the DB)
+        await self.flush(replay=True)
+        while self.rows_waiting():
+            await self.flush()
+
+    # --- flushing ---
+    async def flush(self, replay: bool = False):
+        async with self.lock:
+            tables = [t for t, rows in self.rows.items() if rows]
+            await asyncio.gather(*(self._flush_table(t) for t in tables))
+            if self.spooled and (replay or time.monotonic() >= self.next_replay):
+                await self._replay_spool()
+
+    def rows_waiting(self) -> int:
+        return sum(len(r) for r in self.rows.values())
+
+    async def _upsert(self, table: str, rows: List[dict]):
+        # Upsert on the client-made id: a replayed batch that already landed is a no-op
+        await self.db.execute(f"{table}.bulk_insert", self.db.table(table).upsert(
+            rows, on_conflict=self.conflict_columns.get(table, "id"), ignore_duplicates=True
+        ))
+
+    async def _write(self, table: str, rows: List[dict]) -> List[dict]:
+        """Writes `rows` and returns those that could not be written.
+
+        A failed batch is retried row by row so one bad row doesn't hold back the
+        rest; if the first three rows fail on their own too, the DB is taken to be down.
+        """
+        try:
+            await self._upsert(table, rows)
+            return []
+        except Exception as e:
+            log("write_behind_flush_error", level="error", table=table, rows=len(rows), error=str(e))
+        if len(rows) == 1:
+            return rows
+        failed = []
+        for i, row in enumerate(rows):
+            self.counters["row_retries"] += 1
+            try:
+                await self._upsert(table, [row])
+            except Exception as e:
+                failed.append(row)
+                if len(failed) == i + 1 >= 3:
+                    return rows
+                log("write_behind_row_error", level="error", table=table, id=row["id"], error=str(e))
+        return failed
+
+    def _backoff(self, failed: bool):
+        if not failed:
+            self.failures = 0
+            return
+        self.failures += 1
+        # Back off while the DB is down instead of hammering it every interval
+        self.next_replay = time.monotonic() + min(self.spool_retry * 2 ** (self.failures - 1), 600)
+
+    async def _flush_table(self, table: str):
+        batch = self.rows.pop(table, [])
+        if not batch:
+            return
+        self.inflight[table] = self.inflight.get(table, []) + batch
+        started = asyncio.get_running_loop().time()
+        try:
+            failed = await self._write(table, batch)
+            self.counters["flushed"] += len(batch) - len(failed)
+            self.counters["batches"] += 1
+            self._backoff(bool(failed))
+            if failed:
+                self._spool([{"table": table, "row": r, "attempts": 1} for r in failed])
+        except asyncio.CancelledError:
+            # Shutdown cancelled the flush loop mid-write: close() flushes these again
+            self.rows[table] = batch + self.rows.get(table, [])
+            raise
+        finally:
+            ids = {r["id"] for r in batch}
+            self.inflight[table] = [r for r in self.inflight.get(table, []) if r["id"] not in ids]
+            self.flush_latency.observe(asyncio.get_running_loop().time() - started)
+
+    # --- spool (local at-least-once backup) ---
+    def _load_spool(self):
+        self.spooled = []
+        if not os.path.exists(self.spool_path):
+            return
+        try:
+            with open(self.spool_path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError as e:
+            log("write_behind_spool_error", level="error", error=str(e))
+            return
+        for line in lines:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            self.spooled.append({"table": item["table"], "row": item["row"], "attempts": item.get("attempts", 1)})
+
+    def _spool(self, items: List[dict]):
+        try:
+            with open(self.spool_path, "a", encoding="utf-8") as f:
+                for item in items:
+                    f.write(json.dumps(item, ensure_ascii=False, default=str) + "\n")
+        except OSError as e:
+            self.counters["dropped"] += len(items)
+            log("write_behind_spool_error", level="error", rows=len(items), error=str(e))
+            return
+        self.spooled.extend(items)
+        self.counters["spooled"] += len(items)
+
+    def _rewrite_spool(self, items: List[dict]) -> bool:
+        """Replaces the spool file with `items` (atomically; removed when empty)."""
+        try:
+            if not items:
+                if os.path.exists(self.spool_path):
+                    os.remove(self.spool_path)
+            else:
+                tmp = self.spool_path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    for item in items:
+                        f.write(json.dumps(item, ensure_ascii=False, default=str) + "\n")
+                os.replace(tmp, self.spool_path)
+        except OSError as e:
+            log("write_behind_spool_error", level="error", error=str(e))
+            return False
+        self.spooled = items
+        return True
+
+    async def _replay_spool(self):
+        """Writes the spooled rows; the file keeps every row until it has landed."""
+        items = list(self.spooled)
+        by_table: Dict[str, List[dict]] = {}
+        for item in items:
+            by_table.setdefault(item["table"], []).append(item)
+        kept = []
+        for table, table_items in by_table.items():
+            for i in range(0, len(table_items), self.max_rows):
+                chunk = table_items[i:i + self.max_rows]
+                failed = {r["id"] for r in await self._write(table, [item["row"] for item in chunk])}
+                for item in chunk:
+                    if item["row"]["id"] not in failed:
+                        self.counters["replayed"] += 1
+                    elif item["attempts"] + 1 >= self.max_attempts:
+                        self.counters["dropped"] += 1
+                        log("write_behind_row_dropped", level="error", table=table, row=item["row"])
+                    else:
+                        kept.append({**item, "attempts": item["attempts"] + 1})
+        self._backoff(bool(kept))
+        self._rewrite_spool(kept)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "waiting": self.rows_waiting(),
+            "inflight": sum(len(r) for r in self.inflight.values()),
+            "spooled_rows": len(self.spooled),
+            "spool_bytes": os.path.getsize(self.spool_path) if os.path.exists(self.spool_path) else 0,
+            "flush_latency": self.flush_latency.summary(),
+        }